@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+"""
+Measures decode_filenames_in_text on a post text with thousands of ##N##
+placeholders and on many short comments, as they are decoded once the files
+of a post have been downloaded, against the decoding it replaced, which
+replaced every placeholder found in the whole text one by one (quadratic in
+the number of placeholders).
+
+Usage: python bench/bench_decode.py [placeholders] [comments]
+"""
+
+import random
+import re
+import sys
+
+from bench_helpers import load_lj_dl, measure
+
+
+def legacy_decode_filenames_in_text(downloader, text):
+  """
+  decode_filenames_in_text as it was before the single pass.
+  """
+  if not text:
+    return text
+
+  m_list = re.findall(downloader.get_file_id_mark_regex(), text, re.MULTILINE)
+  if not m_list:
+    return text
+
+  for m in m_list:
+    file_id = downloader.make_file_id_mark_by_id(m)
+    filename = downloader.compose_link_to_file(
+        downloader.get_filename_by_id(file_id))
+    text = text.replace(file_id, filename)
+
+  return text
+
+
+def compare(name, run_legacy, run_new):
+  # the legacy decoding is slow on long texts, so it is run once
+  elapsed_legacy, result_legacy = measure(run_legacy, repeat=1)
+  elapsed_new, result_new = measure(run_new)
+  print('%s: legacy %.3f s, new %.3f s (x%.1f)%s' % (
+      name, elapsed_legacy, elapsed_new, elapsed_legacy / elapsed_new,
+      '' if result_legacy == result_new else ', DIFFERENT OUTPUT'))
+
+
+def main():
+  placeholders = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+  comments = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+  lj_dl = load_lj_dl()
+  random.seed(2)
+
+  class Downloader(lj_dl.AbstractFileDownloader):
+    def compose_link_to_file(self, filename):
+      return '../{}'.format(filename)
+
+  downloader = Downloader('.')
+  for i in range(placeholders):
+    downloader.files['##%d##' % i] = 'images/%064x.png' % i
+
+  text = ''.join('some text <img src = "##%d##" > ' %
+                 random.randrange(placeholders) for _ in range(placeholders))
+  texts = ['comment <img src ="##%d##" >' % random.randrange(placeholders)
+           for _ in range(comments)]
+
+  compare('post (%d placeholders in %.1f MB)' % (
+              placeholders, len(text) / 1e6),
+          lambda: legacy_decode_filenames_in_text(downloader, text),
+          lambda: downloader.decode_filenames_in_text(text))
+  compare('comments (%d with one placeholder each)' % len(texts),
+          lambda: [legacy_decode_filenames_in_text(downloader, t)
+                   for t in texts],
+          lambda: [downloader.decode_filenames_in_text(t) for t in texts])
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+"""
+Measures extract_json_contents on comment thread pages against the
+extraction it replaced, which searched the whole page with a regular
+expression for every section. Pages saved from livejournal.com may be given
+as arguments, otherwise thread pages of a few megabytes are generated with
+the Site.page section near the top and near the bottom of the page.
+
+Usage: python bench/bench_extract.py [page.html ...]
+"""
+
+import json
+import logging
+import random
+import re
+import sys
+
+from bench_helpers import measure
+from parse_helpers import SITE_SECTIONS_DEFAULT, extract_json_contents
+
+
+def legacy_extract_json_contents(page_content,
+                                 sections=SITE_SECTIONS_DEFAULT):
+  """
+  extract_json_contents as it was before the single scan.
+  """
+  contents = {}
+  for section_name in sections:
+    m = re.search(('^.*Site.%s = (.+);' % (section_name)), page_content,
+                  re.MULTILINE)
+    if m is None:
+      logging.error("Warning: Parsing the page: no json content of section "
+                    "'%s'" % (section_name))
+      continue
+    contents[section_name] = json.loads(m.group(1))
+  return contents
+
+
+def make_thread_page(comment_count, html_lines, at_top):
+  comments = [{
+      'thread': i,
+      'uname': 'user%d' % i,
+      'article': 'text; more <b>text</b> ' * random.randrange(1, 30),
+      'level': 1,
+      'collapsed': 0,
+  } for i in range(comment_count)]
+  script = '<script>\nSite.page = %s;\nSite.entry = %s;\n</script>' % (
+      json.dumps({'replycount': comment_count, 'comments': comments}),
+      json.dumps({'poster': 'user', 'title': 'title'}))
+  html = ''.join(
+      '<div class="c%d"><a href="https://user.livejournal.com/%d.html">link '
+      '%d</a> some text here and there</div>\n' % (i, i, i)
+      for i in range(html_lines))
+  if at_top:
+    return '<html><head>%s</head><body>\n%s</body></html>' % (script, html)
+  return '<html><body>\n%s%s</body></html>' % (html, script)
+
+
+def main():
+  logging.basicConfig(level=logging.CRITICAL)
+  pages = []
+  for filename in sys.argv[1:]:
+    with open(filename, 'r', encoding='utf-8') as f:
+      pages.append((filename, f.read()))
+  if not pages:
+    random.seed(3)
+    pages.append(('Site.page at the top',
+                  make_thread_page(3000, 20000, at_top=True)))
+    pages.append(('Site.page at the bottom',
+                  make_thread_page(3000, 20000, at_top=False)))
+
+  for name, page in pages:
+    print('%s (%.1f MB):' % (name, len(page) / 1e6))
+    for label, sections in (('all sections', SITE_SECTIONS_DEFAULT),
+                            ('Site.page only', ('page',))):
+      elapsed_legacy, contents_legacy = measure(
+          lambda: legacy_extract_json_contents(page, sections))
+      elapsed_new, contents_new = measure(
+          lambda: extract_json_contents(page, sections))
+      print('  %s: legacy %.4f s, new %.4f s (x%.1f)%s' % (
+          label, elapsed_legacy, elapsed_new, elapsed_legacy / elapsed_new,
+          '' if contents_legacy == contents_new else ', DIFFERENT OUTPUT'))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,51 @@
+"""
+"""
+
+import importlib.util
+import os
+import sys
+import time
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, ROOT_DIR)
+
+
+def load_lj_dl():
+  """
+  Imports lj-dl.py, its name is not a valid module name.
+  """
+  spec = importlib.util.spec_from_file_location(
+      'lj_dl', os.path.join(ROOT_DIR, 'lj-dl.py'))
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+
+def measure(func, repeat=3):
+  """
+  Returns the best time of `repeat` calls of `func` and its last result.
+  """
+  best = None
+  for _ in range(repeat):
+    started = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - started
+    if best is None or elapsed < best:
+      best = elapsed
+  return best, result
+
+
+class PlaceholderDownloader():
+  """
+  Downloader which plans every file without downloading it.
+  """
+
+  def __init__(self):
+    self.urls = {}
+
+  def plan_to_download(self, url):
+    if url not in self.urls:
+      self.urls[url] = '##%d##' % len(self.urls)
+    return self.urls[url]
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+"""
+Measures LJPostParser on a post of several megabytes and LJCommentParser on
+thousands of comments against the parsers they replaced, which appended
+every piece of a text to a string (quadratic in the length of the text).
+Both are run on the same input and must produce the same texts.
+
+Usage: python bench/bench_parsers.py [paragraphs] [comments]
+"""
+
+import random
+import re
+import sys
+from html.parser import HTMLParser
+
+from bench_helpers import PlaceholderDownloader, load_lj_dl, measure
+from constants import (ENUM_POST, ENUM_COM)
+
+
+PARAGRAPH = (
+    '<p class="x" style="y">Lorem ipsum dolor <b>sit</b> amet &amp; more '
+    'text <img src="https://img.example.com/%d.png" alt="a"> '
+    '<a href="https://example.com/%d">link</a><br></p>\n')
+
+
+# the parsers as they were before the texts were built from fragment lists
+
+class LegacyPostParser(HTMLParser):
+
+  PS_TEXT     = 'ps-text'
+  PS_DATE     = 'ps-date'
+  PS_COMPAGES = 'ps-comment-pages'
+
+  def __init__(self, downloader, post):
+    HTMLParser.__init__(self)
+    self.state = []
+    self.post = post
+    self.downloader = downloader
+
+  def _set_state(self, new_state):
+      self.state.append(new_state)
+
+  def _pop_state(self):
+      state = self.state.pop()
+
+  def handle_starttag(self, tag, attrs):
+    if len(self.state) > 0 and self.state[-1] == self.PS_TEXT:
+      # stop condition
+      if tag == 'a':
+        if attrs and len(attrs) > 0:
+          k, v = attrs[0]
+          if k == 'name' and re.search('cutid1-end', v):
+            self._pop_state()
+            return
+      # include given tag
+      self.post[ENUM_POST.TEXT] += ('<%s ' % tag)
+      for k, v in attrs:
+        # images
+        if tag == 'img' and k == 'src':
+          v = self.downloader.plan_to_download(v)
+
+        self.post[ENUM_POST.TEXT] += '%s = "%s" ' % (k, v)
+      self.post[ENUM_POST.TEXT] += '>'
+      return
+
+    # handle tags
+    if tag == 'ul':
+      if attrs and len(attrs) > 0:
+        k, v = attrs[0]
+        if k == 'class' and re.search('b-pager-pages', v):
+          self._set_state(self.PS_COMPAGES)
+          self.post[ENUM_POST.COMPAGES] = []
+    elif tag == 'a':
+      if (attrs and len(attrs) == 1 and len(self.state) > 0 and
+          self.state[-1] == self.PS_COMPAGES):
+        k, v = attrs[0]
+        if k == 'href':
+          self.post[ENUM_POST.COMPAGES].append(v)
+    elif tag == 'time':
+      self._set_state(self.PS_DATE)
+      self.post[ENUM_POST.DATE] = ''
+    elif tag == 'article':
+      if attrs and len(attrs) > 0:
+        k, v = attrs[0]
+        if (k == 'class' and (
+            re.search('b-singlepost-body entry-content e-content', v) or
+            re.search('aentry-post__text aentry-post__text--view', v)
+            )):
+          self._set_state(self.PS_TEXT)
+          self.post[ENUM_POST.TEXT] = ''
+    elif tag == 'meta':
+      if attrs and len(attrs) > 1:
+        k0, v0 = attrs[0]
+        k1, v1 = attrs[1]
+        if k0 == 'property' and v0 == 'article:tag' and k1 == 'content':
+          self.post[ENUM_POST.TAGS][v1] = 1
+
+  def handle_endtag(self, tag):
+    if len(self.state) == 0: return
+
+    if self.state[-1] == self.PS_TEXT:
+      if tag == 'article':
+        self._pop_state()
+      elif tag == 'br':
+        pass
+      else:
+        self.post[ENUM_POST.TEXT] += (' </%s> ' % tag)
+      return
+
+    # handle tags
+    if tag == 'ul' and self.state[-1] == self.PS_COMPAGES:
+      self._pop_state()
+    elif tag == 'time':
+      assert self.state[-1] == self.PS_DATE
+      self._pop_state()
+
+  def handle_data(self, data):
+    if len(self.state) == 0: return
+
+    if self.state[-1] == self.PS_TEXT:
+      self.post[ENUM_POST.TEXT] += data
+    elif self.state[-1] == self.PS_DATE:
+      self.post[ENUM_POST.DATE] += data
+
+
+class LegacyCommentParser(HTMLParser):
+  def __init__(self, downloader, comment):
+    HTMLParser.__init__(self)
+    self.comment    = comment
+    self.downloader = downloader
+
+  def handle_starttag(self, tag, attrs):
+    # include given tag
+    self.comment[ENUM_COM.TEXT] += "<%s " % tag
+    for k, v in attrs:
+      # images
+      if tag == 'img' and k == 'src':
+        v = self.downloader.plan_to_download(v)
+
+      self.comment[ENUM_COM.TEXT] += '%s ="%s" ' % (k, v)
+    self.comment[ENUM_COM.TEXT] += '>'
+
+  def handle_endtag(self, tag):
+    if tag == 'br':
+      return
+    self.comment[ENUM_COM.TEXT] += ' </%s> ' % tag
+
+  def handle_data(self, data):
+    self.comment[ENUM_COM.TEXT] += data
+
+
+def make_paragraphs(count):
+  return ''.join(PARAGRAPH % (random.randrange(500), i) for i in range(count))
+
+
+def parse_post(parser_class, page):
+  post = {ENUM_POST.TAGS: {}}
+  parser = parser_class(PlaceholderDownloader(), post)
+  parser.feed(page)
+  if hasattr(parser, 'finish'):
+    parser.finish()
+  return post
+
+
+def parse_comments(parser_class, texts):
+  downloader = PlaceholderDownloader()
+  comments = []
+  for text in texts:
+    comment = {ENUM_COM.TEXT: ''}
+    parser = parser_class(downloader, comment)
+    parser.feed(text)
+    if hasattr(parser, 'finish'):
+      parser.finish()
+    comments.append(comment)
+  return comments
+
+
+def compare(name, size, run_legacy, run_new):
+  # the legacy parser is slow on long texts, so it is run once
+  elapsed_legacy, result_legacy = measure(run_legacy, repeat=1)
+  elapsed_new, result_new = measure(run_new)
+  print('%s %s: legacy %.3f s, new %.3f s (x%.1f)%s' % (
+      name, size, elapsed_legacy, elapsed_new, elapsed_legacy / elapsed_new,
+      '' if result_legacy == result_new else ', DIFFERENT OUTPUT'))
+
+
+def main():
+  paragraphs = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+  comments = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+  lj_dl = load_lj_dl()
+  random.seed(1)
+
+  page = (
+      '<html><head><meta property="article:tag" content="t"></head><body>'
+      '<time>2019-02-20 13:45:00</time>'
+      '<article class="b-singlepost-body entry-content e-content">' +
+      make_paragraphs(paragraphs) + '</article></body></html>')
+  compare('LJPostParser', '(%.1f MB post)' % (len(page) / 1e6),
+          lambda: parse_post(LegacyPostParser, page),
+          lambda: parse_post(lj_dl.LJPostParser, page))
+
+  texts = [make_paragraphs(random.randrange(1, 40)) for _ in range(comments)]
+  compare('LJCommentParser', '(%d comments, %.1f MB)' % (
+              len(texts), sum(map(len, texts)) / 1e6),
+          lambda: parse_comments(LegacyCommentParser, texts),
+          lambda: parse_comments(lj_dl.LJCommentParser, texts))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,81 @@
+"""
+"""
+
+import hashlib
+import json
+import os
+
+from helpers import get_file_hash
+
+
+def get_data_hash(data):
+  return hashlib.sha256(json.dumps(
+      data, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class BuildManifest():
+  """
+  Sources of the generated HTML pages: for every page the hash of the data
+  it has been rendered from and the version of the renderer. A page is
+  rendered again only if its source or the renderer has changed since, or
+  the page is missing. The source files are hashed only if their size or
+  modification time differs from the recorded ones.
+  """
+
+  FILENAME = 'manifest.json'
+
+  def __init__(self, html_dir, version):
+    self.html_dir = html_dir
+    self.filename = '%s/%s' % (html_dir, self.FILENAME)
+    self.version = version
+    self.pages = {}   # { page: { 'version', 'hash'[, 'mtime', 'size'] } }
+    if os.path.isfile(self.filename):
+      with open(self.filename, 'r', encoding='utf-8') as f:
+        self.pages = json.load(f)
+    self.changed = False
+
+  def get_file_source(self, page, filename):
+    """
+    Returns the state of the source file of a page or None if there is no
+    such file.
+    """
+    try:
+      st = os.stat(filename)
+    except FileNotFoundError:
+      return None
+
+    source = {'mtime': st.st_mtime_ns, 'size': st.st_size}
+    entry = self.pages.get(page)
+    if (entry is not None and entry.get('mtime') == source['mtime'] and
+        entry.get('size') == source['size']):
+      source['hash'] = entry['hash']
+    else:
+      source['hash'] = get_file_hash(filename)
+    return source
+
+  @staticmethod
+  def get_data_source(data):
+    return {'hash': get_data_hash(data)}
+
+  def is_up_to_date(self, page, source):
+    entry = self.pages.get(page)
+    return (source is not None and entry is not None and
+            entry.get('version') == self.version and
+            entry.get('hash') == source['hash'] and
+            os.path.isfile('%s/%s' % (self.html_dir, page)))
+
+  def set_page(self, page, source):
+    entry = dict(source, version=self.version)
+    if self.pages.get(page) != entry:
+      self.pages[page] = entry
+      self.changed = True
+
+  def save(self):
+    if not self.changed:
+      return
+
+    tmp_file = self.filename + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+      json.dump(self.pages, f, ensure_ascii=False)
+    os.replace(tmp_file, self.filename)
+    self.changed = False
@@ -28,6 +28,18 @@ class _EnumIndex(object):
   @constant
   def POST_ID():
     return "index-post-id"
+  @constant
+  def POST_REPLYCOUNT():
+    return "index-post-replycount"
+  @constant
+  def POST_COMMENT_COUNT():
+    return "index-post-comment-count"
+  @constant
+  def POST_ETAG():
+    return "index-post-etag"
+  @constant
+  def POST_LAST_MODIFIED():
+    return "index-post-last-modified"
 
 
 class _EnumPost(object):
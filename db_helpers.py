@@ -0,0 +1,220 @@
+"""
+"""
+
+import json
+import logging
+import sqlite3
+
+from build_helpers import get_data_hash
+from constants import (ENUM_INDEX, ENUM_POST, ENUM_COM)
+
+
+class PostDatabase():
+  """
+  SQLite database with the saved posts of a journal, their tags, comments
+  and files, so a journal can be queried (e.g. all comments of a user or
+  all posts with a tag) without loading every '<postid>.data' file. The json
+  files are still written and can be imported with 'add_post_file'.
+  """
+
+  FILENAME = 'posts.sqlite'
+
+  SCHEMA = """
+CREATE TABLE IF NOT EXISTS posts (
+  id            TEXT PRIMARY KEY,
+  header        TEXT,
+  author        TEXT,
+  date          TEXT,
+  link          TEXT,
+  text          TEXT,
+  replycount    INTEGER,
+  comment_pages TEXT,
+  hash          TEXT
+);
+CREATE TABLE IF NOT EXISTS tags (
+  post_id       TEXT NOT NULL REFERENCES posts(id) ON DELETE CASCADE,
+  tag           TEXT NOT NULL,
+  PRIMARY KEY (post_id, tag)
+);
+CREATE TABLE IF NOT EXISTS comments (
+  post_id       TEXT NOT NULL REFERENCES posts(id) ON DELETE CASCADE,
+  position      INTEGER NOT NULL,
+  thread        INTEGER,
+  parent        INTEGER,
+  level         INTEGER,
+  user          TEXT,
+  userpic       TEXT,
+  date          TEXT,
+  ts            INTEGER,
+  thread_url    TEXT,
+  text          TEXT,
+  extra         TEXT,
+  PRIMARY KEY (post_id, position)
+);
+CREATE TABLE IF NOT EXISTS files (
+  post_id       TEXT NOT NULL REFERENCES posts(id) ON DELETE CASCADE,
+  url           TEXT NOT NULL,
+  filename      TEXT NOT NULL,
+  PRIMARY KEY (post_id, url)
+);
+CREATE INDEX IF NOT EXISTS tags_tag ON tags (tag);
+CREATE INDEX IF NOT EXISTS comments_thread ON comments (post_id, thread);
+CREATE INDEX IF NOT EXISTS comments_parent ON comments (post_id, parent);
+CREATE INDEX IF NOT EXISTS comments_user ON comments (user);
+CREATE INDEX IF NOT EXISTS comments_ts ON comments (ts);
+CREATE INDEX IF NOT EXISTS files_filename ON files (filename);
+"""
+
+  # comment fields kept in their own columns, the rest goes to 'extra'
+  COMMENT_COLUMNS = (
+      ('thread',     ENUM_COM.THREAD),
+      ('parent',     ENUM_COM.PARENT),
+      ('level',      ENUM_COM.LEVEL),
+      ('user',       ENUM_COM.USER),
+      ('userpic',    ENUM_COM.USERPIC),
+      ('date',       ENUM_COM.DATE),
+      ('ts',         ENUM_COM.DATETS),
+      ('thread_url', ENUM_COM.THREADURL),
+      ('text',       ENUM_COM.TEXT),
+  )
+
+  def __init__(self, main_dir):
+    self.filename = '%s/%s' % (main_dir, self.FILENAME)
+    self.conn = sqlite3.connect(self.filename)
+    self.conn.execute('PRAGMA foreign_keys = ON')
+    self.conn.executescript(self.SCHEMA)
+    columns = [row[1] for row in self.conn.execute('PRAGMA table_info(posts)')]
+    if 'hash' not in columns:
+      self.conn.execute('ALTER TABLE posts ADD COLUMN hash TEXT')
+    logging.info("Post database '%s'", self.filename)
+
+  def close(self):
+    self.conn.close()
+
+  def has_post(self, postid):
+    return self.conn.execute(
+        'SELECT 1 FROM posts WHERE id = ?', (postid,)).fetchone() is not None
+
+  def add_post(self, post, files=None):
+    """
+    Adds a new post or replaces a saved one together with its tags, comments
+    and files { url: filename } in one transaction.
+    """
+    postid = post[ENUM_POST.ID]
+    comment_keys = set(key for _, key in self.COMMENT_COLUMNS)
+    with self.conn:
+      self.conn.execute('DELETE FROM posts WHERE id = ?', (postid,))
+      self.conn.execute(
+          'INSERT INTO posts (id, header, author, date, link, text, '
+          'replycount, comment_pages, hash) '
+          'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+          (postid, post.get(ENUM_POST.HEADER), post.get(ENUM_POST.AUTHOR),
+           post.get(ENUM_POST.DATE), post.get(ENUM_POST.LINK),
+           post.get(ENUM_POST.TEXT), post.get(ENUM_POST.REPLYCOUNT),
+           json.dumps(post.get(ENUM_POST.COMPAGES)), get_data_hash(post)))
+      self.conn.executemany(
+          'INSERT INTO tags (post_id, tag) VALUES (?, ?)',
+          ((postid, tag) for tag in post.get(ENUM_POST.TAGS) or {}))
+      self.conn.executemany(
+          'INSERT INTO comments (post_id, position, thread, parent, level, '
+          'user, userpic, date, ts, thread_url, text, extra) '
+          'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+          ((postid, position) +
+           tuple(com.get(key) for _, key in self.COMMENT_COLUMNS) +
+           (json.dumps({k: v for k, v in com.items()
+                        if k not in comment_keys}, ensure_ascii=False),)
+           for position, com in enumerate(post.get(ENUM_POST.COMMENTS, []))))
+      self.conn.executemany(
+          'INSERT INTO files (post_id, url, filename) VALUES (?, ?, ?)',
+          ((postid, url, filename)
+           for url, filename in (files or {}).items()))
+
+  def add_post_file(self, fdata):
+    """
+    Imports a post saved as a json file.
+    """
+    with open(fdata, 'r', encoding='utf-8') as f:
+      self.add_post(json.load(f))
+
+  def get_post(self, postid, with_comments=True):
+    """
+    Returns the post in the same format as it is saved to '<postid>.data'
+    (without the comments unless `with_comments`) or None if there is no
+    such post.
+    """
+    row = self.conn.execute(
+        'SELECT header, author, date, link, text, replycount, comment_pages '
+        'FROM posts WHERE id = ?', (postid,)).fetchone()
+    if row is None:
+      return None
+
+    header, author, date, link, text, replycount, comment_pages = row
+    post = {
+        ENUM_POST.ID:         postid,
+        ENUM_POST.HEADER:     header,
+        ENUM_POST.TAGS:       self.get_tags(postid),
+        ENUM_POST.DATE:       date,
+        ENUM_POST.TEXT:       text,
+        ENUM_POST.LINK:       link,
+        ENUM_POST.AUTHOR:     author,
+        ENUM_POST.REPLYCOUNT: replycount,
+        ENUM_POST.COMPAGES:   json.loads(comment_pages),
+    }
+    if with_comments:
+      post[ENUM_POST.COMMENTS] = list(self.iter_comments(postid))
+    return post
+
+  def iter_comments(self, postid):
+    """
+    Iterates over the comments of a post in their order on the page.
+    """
+    cursor = self.conn.execute(
+        'SELECT %s, extra FROM comments WHERE post_id = ? ORDER BY position' %
+        ', '.join(column for column, _ in self.COMMENT_COLUMNS), (postid,))
+    for row in cursor:
+      com = json.loads(row[-1])
+      for (_, key), value in zip(self.COMMENT_COLUMNS, row):
+        com[key] = value
+      yield com
+
+  def get_comment_count(self, postid):
+    return self.conn.execute(
+        'SELECT COUNT(*) FROM comments WHERE post_id = ?', (postid,)
+    ).fetchone()[0]
+
+  def get_post_hashes(self):
+    """
+    Returns the hashes { postid: hash } of the saved posts which change
+    whenever a post is saved with different contents.
+    """
+    hashes = dict(self.conn.execute('SELECT id, hash FROM posts'))
+    # posts saved before the hashes were kept
+    for postid in [p for p, h in hashes.items() if h is None]:
+      hashes[postid] = get_data_hash(self.get_post(postid))
+      with self.conn:
+        self.conn.execute('UPDATE posts SET hash = ? WHERE id = ?',
+                          (hashes[postid], postid))
+    return hashes
+
+  def get_tags(self, postid):
+    return {tag: 1 for tag, in self.conn.execute(
+        'SELECT tag FROM tags WHERE post_id = ? ORDER BY rowid', (postid,))}
+
+  def get_index_posts(self):
+    """
+    Returns the saved posts { postid: index post } in the index format.
+    """
+    posts = {}
+    for postid, header, date, replycount in self.conn.execute(
+        'SELECT id, header, date, replycount FROM posts'):
+      posts[postid] = {
+          ENUM_INDEX.POST_ID:         postid,
+          ENUM_INDEX.POST_HEADER:     header,
+          ENUM_INDEX.POST_DATE:       date,
+          ENUM_INDEX.POST_TAGS:       {},
+          ENUM_INDEX.POST_REPLYCOUNT: replycount,
+      }
+    for postid, tag in self.conn.execute(
+        'SELECT post_id, tag FROM tags ORDER BY rowid'):
+      posts[postid][ENUM_INDEX.POST_TAGS][tag] = 1
+    return posts
@@ -4,75 +4,298 @@
 import aiohttp
 import asyncio
 import logging
-from contextlib import closing
+import urllib.parse
+
+from limit_helpers import (HostLimiter, parse_retry_after)
+from parse_helpers import SiteSectionScanner
+from retry_helpers import RetryPolicy
+
+
+class LimitedRequest():
+  """
+  Request which waits for the limiter of its host before it starts and
+  reports the response to it, used like the context manager of
+  `aiohttp.ClientSession.get`.
+  """
+
+  def __init__(self, client, url, kwargs):
+    self.client = client
+    self.url = url
+    self.kwargs = kwargs
+    self.limiter = None
+    self.request = None
+
+  async def __aenter__(self):
+    self.limiter = self.client.get_limiter(self.url)
+    started = await self.limiter.acquire()
+    try:
+      self.request = self.client.session.get(self.url, **self.kwargs)
+      response = await self.request.__aenter__()
+    except asyncio.TimeoutError:
+      self.limiter.report(started, timeout=True)
+      self.limiter.release()
+      raise
+    except BaseException:
+      self.limiter.release()
+      raise
+
+    self.limiter.report(started, response.status, retry_after=(
+        parse_retry_after(response.headers.get('Retry-After'))))
+    return response
+
+  async def __aexit__(self, exc_type, exc, tb):
+    try:
+      return await self.request.__aexit__(exc_type, exc, tb)
+    finally:
+      self.limiter.release()
+
+
+class HttpClient():
+  """
+  One HTTP client shared by all the downloaders of a process. It keeps
+  connections alive between requests, limits the requests per host (see
+  HostLimiter, up to `limit_per_host` at the same time), retries failed
+  requests (see RetryPolicy), caches DNS lookups and counts how many
+  connections were opened and reused.
+  """
+
+  LIMIT_DEFAULT = 64
+  LIMIT_PER_HOST_DEFAULT = 16
+  DNS_CACHE_TTL = 600
+  KEEPALIVE_TIMEOUT = 30
+  HEADERS = {"Cookie": "adult_explicit=1"}
+
+  def __init__(self, limit=LIMIT_DEFAULT,
+               limit_per_host=LIMIT_PER_HOST_DEFAULT):
+    self.limit = limit
+    self.limit_per_host = limit_per_host
+    self.session = None
+    self.limiters = {}
+    self.retry_policy = RetryPolicy()
+    self.requests = 0
+    self.connections_opened = 0
+    self.connections_reused = 0
+
+  async def _on_request_start(self, session, context, params):
+    self.requests += 1
+
+  async def _on_connection_create_end(self, session, context, params):
+    self.connections_opened += 1
+
+  async def _on_connection_reuseconn(self, session, context, params):
+    self.connections_reused += 1
+
+  async def __aenter__(self):
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(self._on_request_start)
+    trace_config.on_connection_create_end.append(
+        self._on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(
+        self._on_connection_reuseconn)
+    connector = aiohttp.TCPConnector(
+        limit=self.limit, limit_per_host=self.limit_per_host,
+        use_dns_cache=True, ttl_dns_cache=self.DNS_CACHE_TTL,
+        keepalive_timeout=self.KEEPALIVE_TIMEOUT)
+    self.session = aiohttp.ClientSession(
+        connector=connector, trace_configs=[trace_config])
+    return self
+
+  async def __aexit__(self, exc_type, exc, tb):
+    await self.session.close()
+    logging.info("HTTP client: %s", self.get_stats())
+
+  def get_stats(self):
+    stats = "%d requests, %d connections opened, %d connections reused" % (
+        self.requests, self.connections_opened, self.connections_reused)
+    throttled = sum(limiter.throttled for limiter in self.limiters.values())
+    if throttled:
+      stats += ", %d pushbacks" % throttled
+    return stats + ", " + self.retry_policy.get_stats()
+
+  def get_limiter(self, url):
+    host = urllib.parse.urlsplit(url).netloc
+    limiter = self.limiters.get(host)
+    if limiter is None:
+      limiter = self.limiters[host] = HostLimiter(host, self.limit_per_host)
+    return limiter
+
+  def get(self, url, **kwargs):
+    return LimitedRequest(self, url, kwargs)
+
+  async def fetch(self, url, handle_response, semaphore=None, **kwargs):
+    """
+    Requests `url` and returns what `handle_response(response)` returns.
+    Requests which fail with a network error, a timeout or a status the
+    retry policy considers temporary are tried again until the policy gives
+    up, then the last response is handled anyway or the last error is
+    raised. The `semaphore` is held only while a request is running, not
+    while it waits to be tried again.
+    """
+    attempt = 1
+    while True:
+      retry_after = None
+      handled_status = None
+      if semaphore is not None:
+        await semaphore.acquire()
+      try:
+        async with self.get(url, **kwargs) as response:
+          if (self.retry_policy.is_retryable(status=response.status) and
+              self.retry_policy.can_retry(attempt)):
+            err = "%d %s" % (response.status, response.reason)
+            retry_after = parse_retry_after(
+                response.headers.get('Retry-After'))
+          else:
+            handled_status = response.status
+            result = await handle_response(response)
+            if response.status < 400:
+              self.retry_policy.add_success()
+            return result
+      except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        # the status of the response has been judged already
+        if (isinstance(e, aiohttp.ClientResponseError) and
+            e.status == handled_status):
+          raise
+        if not (self.retry_policy.is_retryable(error=e) and
+                self.retry_policy.can_retry(attempt)):
+          raise
+        err = str(e) or e.__class__.__name__
+      finally:
+        if semaphore is not None:
+          semaphore.release()
+
+      await self.retry_policy.wait(url, attempt, err, retry_after)
+      attempt += 1
+
+  async def get_webpage_content(self, addr, headers=None,
+                                response_headers=None):
+    """
+    Returns the content of a web page and an error if it failed. A response
+    '304 Not Modified' to a conditional request (see `headers`) gives no
+    content and no error. Headers of the response are stored into
+    `response_headers` (with lowercase names) if it is given.
+    """
+    request_headers = dict(self.HEADERS)
+    if headers:
+      request_headers.update(headers)
+
+    async def read(response):
+      if response_headers is not None:
+        response_headers.update(
+            (k.lower(), v) for k, v in response.headers.items())
+      if response.status == 304:
+        logging.info("Content of '%s' has not been modified", addr)
+        return None
+      if response.status != 200:
+        raise aiohttp.ClientResponseError(
+            response.request_info, response.history,
+            status=response.status, message=response.reason)
+
+      out = (await response.read()).decode("UTF-8")
+      length = response.headers.get("Content-Length")
+      if length is None:
+        length = "unknown size"
+      logging.info("Downloading content of '%s'... [%s]", addr, length)
+      return out
+
+    try:
+      return await self.fetch(addr, read, headers=request_headers), None
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+      err = str(e) or e.__class__.__name__
+      logging.error("Error: Downloading content of web page '%s' failed (%s)",
+                    addr, err)
+      return None, err
 
 
 class FileDownloader():
 
   @staticmethod
   async def _download(url, dest, session, semaphore, chunk_size=1 << 15):
-    async with semaphore:
+    async def save(response):
       logging.info("Downloading file '%s' --> '%s'", url, dest)
-      try:
-        response = await session.get(url)  # , verify_ssl=False
-      except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-        logging.error("Downloading file '%s': Error occured ('%s')",
-            dest, e)
-        return -1, url, dest
+      if response.status == 200:
+        size = 0
+        with open(dest, 'wb') as file:
+          while True:  # save file
+            chunk = await response.content.read(chunk_size)
+            if not chunk:
+              break
+            file.write(chunk)
+            size += len(chunk)
+        logging.info("Downloading file '%s': Done [%d]", dest, size)
       else:
-        if response.status == 200:
-          size = 0
-          with closing(response), \
-               open(dest, 'wb') as file:
-            while True:  # save file
-              chunk = await response.content.read(chunk_size)
-              if not chunk:
-                break
-              file.write(chunk)
-              size += len(chunk)
-          logging.info("Downloading file '%s': Done [%d]", dest, size)
-        else:
-          logging.error("Downloading file '%s': Error occured (%d)",
-              dest, response.status)
-        return response.status, url, dest
+        logging.error("Downloading file '%s': Error occured (%d)",
+            dest, response.status)
+      return response.status, url, dest
+
+    try:
+      return await session.fetch(url, save, semaphore)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+      logging.error("Downloading file '%s': Error occured ('%s')",
+          dest, e)
+      return -1, url, dest
 
   @staticmethod
-  async def download_files_asynchronously(
-      urls, max_connections):
-    async with aiohttp.ClientSession() as session:
-      semaphore = asyncio.Semaphore(max_connections)
-      tasks = [
-          FileDownloader._download(url, dest, session, semaphore)
-          for url, dest in urls.items()
-      ]
-      return await asyncio.wait(tasks)
+  async def download_file(url, dest, semaphore, session):
+    return await FileDownloader._download(url, dest, session, semaphore)
 
 
 class ContentDownloader():
 
+  # the rest of a page which is smaller than this is read anyway, so that
+  #   the connection can be reused instead of being closed
+  DRAIN_LIMIT = 1 << 17
+
   @staticmethod
-  async def _download(url, session, semaphore, chunk_size=1 << 15):
-    content = None
-    async with semaphore:
-      logging.info("Downloading content of '%s'", url)
-      response = await session.get(url)
+  async def _download_json(url, session, semaphore, sections,
+                           chunk_size=1 << 15):
+    async def scan(response):
+      contents = None
+      logging.info("Downloading json content of '%s'", url)
       if response.status == 200:
-        content = await response.read()
-        size = len(content)
-        content = content.decode('utf-8')
-        logging.info("Downloading content of '%s': Done [%d]", url, size)
+        scanner = SiteSectionScanner(sections)
+        size = 0
+        while True:
+          chunk = await response.content.read(chunk_size)
+          if not chunk:
+            break
+          size += len(chunk)
+          if scanner.feed(chunk):
+            await ContentDownloader._abandon(response, size)
+            break
+        contents = scanner.close()
+        logging.info("Downloading json content of '%s': Done [%d]",
+            url, size)
       else:
-        logging.error("Downloading content of '%s': Error occured (%d)",
+        logging.error("Downloading json content of '%s': Error occured (%d)",
             url, response.status)
-    return response.status, url, content
+      return response.status, url, contents
+
+    try:
+      return await session.fetch(url, scan, semaphore)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+      logging.error("Downloading json content of '%s': Error occured ('%s')",
+          url, e)
+      return -1, url, None
+
+  @staticmethod
+  async def _abandon(response, size, chunk_size=1 << 15):
+    rest = None
+    # the size read is decoded, while the length of an encoded page (e.g.
+    #   gzip) is its size on the wire, so an encoded page is never drained
+    if (response.content_length is not None and
+        response.headers.get('Content-Encoding', 'identity') == 'identity'):
+      rest = response.content_length - size
+    if rest is not None and rest <= ContentDownloader.DRAIN_LIMIT:
+      while await response.content.read(chunk_size):
+        pass
+    else:
+      response.close()
 
   @staticmethod
-  async def download_content_asynchronously(
-      urls, max_connections):
-    async with aiohttp.ClientSession() as session:
-      semaphore = asyncio.Semaphore(max_connections)
-      tasks = [
-          ContentDownloader._download(url, session, semaphore)
-          for url in urls
-      ]
-      return await asyncio.wait(tasks)
+  async def download_json_contents(url, sections, semaphore, session):
+    """
+    Downloads a page only until the json contents of the given `Site.<...>`
+    sections are captured and returns them instead of the page.
+    """
+    return await ContentDownloader._download_json(
+        url, session, semaphore, sections)
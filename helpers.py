@@ -1,8 +1,102 @@
 """
 """
 
+import hashlib
+import json
+import logging
+import os
+
+
 def confirm(question):
   answer = ""
   while answer not in ['y', 'n']:
     answer = str(input("%s (y/n): " % question)).lower().strip()
   return answer == 'y'
+
+
+def get_file_hash(filename, chunk_size=1 << 16):
+  h = hashlib.sha256()
+  with open(filename, 'rb') as f:
+    while True:
+      chunk = f.read(chunk_size)
+      if not chunk:
+        break
+      h.update(chunk)
+  return h.hexdigest()
+
+
+class JsonLog():
+  """
+  Append-only log of json records, one per line. A record which is cut off
+  at the end (the process was killed while writing it) is ignored and the
+  next append overwrites it, so the size of the valid records is kept after
+  every read and write.
+  """
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.records = 0
+    self.size = 0     # size of the valid records
+    self.file = None
+
+  def exists(self):
+    return os.path.isfile(self.filename)
+
+  def read(self):
+    """
+    Iterates over the valid records of the log.
+    """
+    with open(self.filename, 'rb') as f:
+      for line in f:
+        try:
+          record = json.loads(line.decode('utf-8'))
+        except ValueError:
+          logging.warning("Log '%s': ignoring a broken record", self.filename)
+          break
+        self.records += 1
+        self.size += len(line)
+        yield record
+
+  @staticmethod
+  def _dump(record):
+    return (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+
+  def append(self, record):
+    if self.file is None:
+      self.file = open(self.filename, 'ab')
+      self.file.truncate(self.size)
+    line = self._dump(record)
+    self.file.write(line)
+    self.file.flush()
+    self.records += 1
+    self.size += len(line)
+
+  def rewrite(self, records):
+    """
+    Replaces the log with the given records at once.
+    """
+    self.close()
+    tmp_file = self.filename + '.tmp'
+    records_count = 0
+    size = 0
+    with open(tmp_file, 'wb') as f:
+      for record in records:
+        line = self._dump(record)
+        f.write(line)
+        records_count += 1
+        size += len(line)
+    os.replace(tmp_file, self.filename)
+    self.records = records_count
+    self.size = size
+
+  def remove(self):
+    self.close()
+    if os.path.isfile(self.filename):
+      os.remove(self.filename)
+    self.records = 0
+    self.size = 0
+
+  def close(self):
+    if self.file is not None:
+      self.file.close()
+      self.file = None
@@ -0,0 +1,98 @@
+"""
+"""
+
+import json
+import logging
+import os
+
+from constants import ENUM_INDEX
+from helpers import JsonLog
+
+
+class PostIndex():
+  """
+  Index of the saved posts of a journal. It is kept as an append-only log
+  '<ljuser>/index.log' of json records, one per line, so adding or updating
+  a post appends one line instead of rewriting the whole index. The last
+  record of a post wins. When the log has grown much bigger than the index
+  it is compacted. An old '<ljuser>/index.data' is migrated on the first
+  load. Readers which may run along with a writer (lj-cv.py) load the index
+  read-only: it is neither compacted nor migrated, since the writer keeps
+  appending to the file it has opened.
+  """
+
+  LOG = 'index.log'
+  LEGACY = 'index.data'
+  COMPACT_RATIO = 2
+  COMPACT_MIN_RECORDS = 64
+
+  def __init__(self, ljuser, main_dir=None):
+    self.ljuser = ljuser
+    self.main_dir = main_dir if main_dir is not None else ljuser
+    self.log = JsonLog('%s/%s' % (self.main_dir, self.LOG))
+    self.posts = {}   # { postid: index post }
+    self.date = None
+
+  def load(self, read_only=False):
+    if self.log.exists():
+      self._load_log()
+      if not read_only and self.log.records > max(
+          self.COMPACT_MIN_RECORDS, self.COMPACT_RATIO * (len(self.posts) + 1)):
+        self.compact()
+    elif os.path.isfile('%s/%s' % (self.main_dir, self.LEGACY)):
+      self._load_legacy()
+      if not read_only:
+        self._migrate()
+    return self
+
+  def _load_log(self):
+    for record in self.log.read():
+      self._apply(record)
+    logging.info("Found index file '%s' (%d posts)",
+                 self.log.filename, len(self.posts))
+
+  def _apply(self, record):
+    if ENUM_INDEX.POST_ID in record:
+      self.posts[record[ENUM_INDEX.POST_ID]] = record
+    elif ENUM_INDEX.DATE in record:
+      self.date = record[ENUM_INDEX.DATE]
+
+  def _load_legacy(self):
+    legacy = '%s/%s' % (self.main_dir, self.LEGACY)
+    with open(legacy, 'r', encoding='utf-8') as f:
+      index = json.load(f)
+    self.posts = dict(index.get(ENUM_INDEX.POSTS, {}))
+    self.date = index.get(ENUM_INDEX.DATE)
+
+  def _migrate(self):
+    legacy = '%s/%s' % (self.main_dir, self.LEGACY)
+    self.compact()
+    os.replace(legacy, legacy + '.bak')
+    logging.info("Index '%s' has been migrated to '%s' (%d posts)",
+                 legacy, self.log.filename, len(self.posts))
+
+  def _get_header(self):
+    return {ENUM_INDEX.LJUSER: self.ljuser, ENUM_INDEX.DATE: self.date}
+
+  def compact(self):
+    """
+    Rewrites the log so that it has one record per post.
+    """
+    self.log.rewrite([self._get_header()] + list(self.posts.values()))
+
+  def get_post(self, postid):
+    return self.posts.get(postid)
+
+  def add_post(self, index_post):
+    """
+    Adds a new post or updates a saved one.
+    """
+    self.posts[index_post[ENUM_INDEX.POST_ID]] = index_post
+    self.log.append(index_post)
+
+  def set_date(self, date):
+    self.date = date
+    self.log.append(self._get_header())
+
+  def close(self):
+    self.log.close()
@@ -0,0 +1,237 @@
+"""
+"""
+
+import asyncio
+import collections
+import email.utils
+import logging
+import time
+
+
+def parse_retry_after(value, now=None):
+  """
+  Returns the delay in seconds given by a 'Retry-After' header (a number of
+  seconds or an HTTP date) or None if it cannot be parsed.
+  """
+  if not value:
+    return None
+
+  value = value.strip()
+  if value.isdigit():
+    return int(value)
+
+  try:
+    date = email.utils.parsedate_to_datetime(value)
+  except (TypeError, ValueError):
+    return None
+  if now is None:
+    now = time.time()
+  return max(0, date.timestamp() - now)
+
+
+class TokenBucket():
+  """
+  Token bucket which lets `rate` requests per second through with bursts of
+  up to `burst` requests, there is no limit while `rate` is None.
+  """
+
+  def __init__(self, rate=None, burst=1):
+    self.rate = rate
+    self.burst = burst
+    self.tokens = burst
+    self.updated = None
+
+  def set_rate(self, rate):
+    self.rate = rate
+    self.tokens = min(self.tokens, self.burst)
+
+  def reserve(self, now):
+    """
+    Takes a token and returns how long to wait until it is available, the
+    tokens taken in advance are paid back by the following requests.
+    """
+    if self.rate is None:
+      return 0
+
+    if self.updated is not None:
+      self.tokens = min(self.burst,
+                        self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+    self.tokens -= 1
+    return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class HostLimiter():
+  """
+  Limits the requests to one host: how many of them run at the same time and
+  how many start per second (a token bucket). Both limits adapt to the server
+  the way TCP does (additive increase, multiplicative decrease): the number
+  of connections grows by one after as many healthy responses while their
+  latency stays close to the lowest one seen, and both limits are halved
+  when the server pushes back (429, 503 or a timeout). A 'Retry-After' of
+  such a response pauses all the requests to the host. Beyond the number of
+  connections at which the server pushed back last time the limit grows
+  PROBE_FACTOR times slower, so the server is not pushed over it every time.
+  """
+
+  CONCURRENCY_INITIAL = 4
+  PROBE_FACTOR = 8
+  BACKOFF = 0.5
+  # responses slower than this times the lowest latency mean a busy server
+  LATENCY_TOLERANCE = 3.0
+  LATENCY_SMOOTHING = 0.2
+  RATE_MIN = 0.5
+  # the rate limit grows with every healthy response and is lifted once it
+  #   is this many times higher than the actual rate of the requests
+  RATE_GROWTH = 1.05
+  RATE_SLACK = 2.0
+  RATE_BURST = 2
+  RATE_WINDOW = 2.0
+  RETRY_AFTER_MAX = 300
+  THROTTLE_STATUSES = (429, 503)
+
+  def __init__(self, host, concurrency_max):
+    self.host = host
+    self.concurrency_max = concurrency_max
+    self.concurrency = min(self.CONCURRENCY_INITIAL, concurrency_max)
+    self.ceiling = concurrency_max
+    self.bucket = TokenBucket(burst=self.RATE_BURST)
+    self.active = 0
+    self.waiters = collections.deque()
+    self.starts = collections.deque()   # start times within RATE_WINDOW
+    self.paused_until = 0
+    self.latency = None
+    self.latency_min = None
+    self.healthy = 0   # healthy responses since the limits last changed
+    self.last_backoff = None
+    self.throttled = 0
+
+  @staticmethod
+  def _now():
+    return asyncio.get_running_loop().time()
+
+  async def acquire(self):
+    """
+    Waits until a request to the host may start and returns its start time
+    to be passed to `report`. Every acquire is followed by a `release`.
+    """
+    if self.active < self.concurrency and not self.waiters:
+      self.active += 1
+    else:
+      waiter = asyncio.get_running_loop().create_future()
+      self.waiters.append(waiter)
+      try:
+        await waiter
+      except asyncio.CancelledError:
+        if waiter.done() and not waiter.cancelled():
+          self.release()
+        elif waiter in self.waiters:
+          # a cancelled waiter may have been dropped by _wake already
+          self.waiters.remove(waiter)
+        raise
+
+    try:
+      reserved = False
+      while True:
+        now = self._now()
+        if self.paused_until > now:
+          await asyncio.sleep(self.paused_until - now)
+        elif not reserved:
+          reserved = True
+          delay = self.bucket.reserve(now)
+          if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+          break
+    except asyncio.CancelledError:
+      self.release()
+      raise
+
+    self.starts.append(now)
+    while self.starts[0] < now - self.RATE_WINDOW:
+      self.starts.popleft()
+    return now
+
+  def release(self):
+    self.active -= 1
+    self._wake()
+
+  def _wake(self):
+    while self.waiters and self.active < self.concurrency:
+      waiter = self.waiters.popleft()
+      if not waiter.done():
+        self.active += 1
+        waiter.set_result(None)
+
+  def get_request_rate(self, now):
+    """
+    Returns the number of requests started per second within RATE_WINDOW or
+    None if too few requests have been started to tell.
+    """
+    if len(self.starts) < 2 or now <= self.starts[0]:
+      return None
+    return (len(self.starts) - 1) / (now - self.starts[0])
+
+  def report(self, started, status=None, timeout=False, retry_after=None):
+    """
+    Adapts the limits to the response (its status, or a timeout) of a
+    request started at `started`.
+    """
+    now = self._now()
+    if timeout or status in self.THROTTLE_STATUSES:
+      self._back_off(started, now, retry_after)
+    elif status is not None and status < 500:
+      self._grow(now - started, now)
+
+  def _grow(self, latency, now):
+    if self.latency is None:
+      self.latency = latency
+    else:
+      self.latency += self.LATENCY_SMOOTHING * (latency - self.latency)
+    if self.latency_min is None or latency < self.latency_min:
+      self.latency_min = latency
+    if self.latency > self.LATENCY_TOLERANCE * max(self.latency_min, 0.001):
+      return
+
+    if self.bucket.rate is not None:
+      rate = self.get_request_rate(now)
+      if rate is not None and self.bucket.rate > self.RATE_SLACK * rate:
+        self.bucket.set_rate(None)
+      else:
+        self.bucket.set_rate(self.bucket.rate * self.RATE_GROWTH)
+
+    self.healthy += 1
+    step = self.concurrency
+    if self.concurrency >= self.ceiling:
+      step *= self.PROBE_FACTOR
+    if self.healthy >= step:
+      self.healthy = 0
+      if self.concurrency < self.concurrency_max:
+        self.concurrency += 1
+        self.ceiling = max(self.ceiling, self.concurrency)
+        self._wake()
+
+  def _back_off(self, started, now, retry_after):
+    self.throttled += 1
+    if retry_after is not None:
+      self.paused_until = max(
+          self.paused_until, now + min(retry_after, self.RETRY_AFTER_MAX))
+
+    # the requests which were running at the last backoff are answered
+    #   according to the old limits
+    if self.last_backoff is not None and started <= self.last_backoff:
+      return
+
+    self.last_backoff = now
+    self.healthy = 0
+    # the request itself is still counted as active
+    self.ceiling = max(1, self.active - 1)
+    self.concurrency = max(1, int(self.concurrency * self.BACKOFF))
+    rate = self.get_request_rate(now)
+    if rate is not None:
+      self.bucket.set_rate(max(self.RATE_MIN, rate * self.BACKOFF))
+    logging.warning(
+        "Warning: Host '%s' pushes back, slowing down to %d connection(s)%s",
+        self.host, self.concurrency,
+        "" if self.bucket.rate is None else
+        " and %.1f request(s) per second" % self.bucket.rate)
@@ -1,71 +1,347 @@
 # -*- coding: utf-8 -*-
 
+from build_helpers import BuildManifest
 from constants import (ENUM_INDEX, ENUM_POST, ENUM_COM)
+from db_helpers import PostDatabase
+from index_helpers import PostIndex
+from parse_helpers import iter_json_object
+from search_helpers import (SEARCH_DIR, SEARCH_CACHE, SearchIndexBuilder,
+                            count_post_terms, render_search_page)
+import argparse
 import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor
 import subprocess
 import re
 import os.path
 import json
 import shutil
+import urllib.parse
+
+# has to be increased whenever the generated HTML changes, so all the pages
+#   are rendered again
+RENDERER_VERSION = 1
+
+# posts saved to bigger files are read by parts, see load_post
+STREAM_MIN_SIZE = 1 << 23
+
+
+def get_post_sort_key(p):
+  # ids are compared as numbers
+  postid = p[ENUM_INDEX.POST_ID]
+  return (p[ENUM_INDEX.POST_DATE] or "", len(postid), postid)
+
+
+def get_tag_page_name(tag):
+  # '-' is escaped too, so the number of a page can't be taken for a tag
+  return "tag-%s" % urllib.parse.quote(tag, safe='').replace('-', '%2D')
+
+
+def make_link(page, text):
+  return "<a href=\"./%s\">%s</a>" % (urllib.parse.quote(page), text)
+
+
+# number of the pages linked before and after the current one
+PAGER_WINDOW = 5
+
+
+def split_into_pages(name, rows, page_size):
+  """
+  Splits the list of rows into pages 'name.html', 'name-p2.html', ...
+  and returns [ (page, rows of the page) ].
+  """
+  pages = []
+  for start in range(0, max(1, len(rows)), page_size):
+    page_num = start // page_size + 1
+    page = ("%s.html" % name if page_num == 1 else
+            "%s-p%d.html" % (name, page_num))
+    pages.append((page, rows[start:start + page_size]))
+  return pages
+
+
+def get_pager(page_links, page_num):
+  """
+  Returns the links of the pager of a page: the first page and a few pages
+  around the current one. The last page is not linked, so a new page at the
+  end of the list changes only the last few pages.
+  """
+  first = max(1, page_num - PAGER_WINDOW)
+  last = min(len(page_links), page_num + PAGER_WINDOW)
+  pager = []
+  if first > 1:
+    pager.append((1, page_links[0]))
+    if first > 2:
+      pager.append((None, None))
+  pager.extend((i, page_links[i - 1]) for i in range(first, last + 1))
+  if last < len(page_links):
+    pager.append((None, None))
+  return pager
+
+
+def render_nav(main_dir, title, search=False):
+  """
+  Returns the links to the index, the archive and the search page.
+  """
+  links = [make_link("index.html", main_dir)]
+  links.append(make_link("archive.html", "Archive")
+               if title != "Archive" else title)
+  if search:
+    links.append(make_link("search.html", "Search"))
+  if title != "Archive":
+    links.append(title)
+  return """
+<div class=\"nav\">
+  %s
+</div>
+""" % " | ".join(links)
 
-def make_index_html_page(main_dir, posts):
 
-  out = "<!DOCTYPE HTML>\n"
-  out += "<html><head>\n"
-  out += "<meta charset=\"utf-8\">\n"
-  out += "<title>%s</title>\n" % main_dir
+def render_list_page(main_dir, title, rows, pager, page_num, search=False):
+  out = []
+  out.append("<!DOCTYPE HTML>\n")
+  out.append("<html><head>\n")
+  out.append("<meta charset=\"utf-8\">\n")
+  out.append("<title>%s</title>\n" % title)
+  out.append("</head>\n")
+  out.append("<body>\n")
 
-  out += "</head>\n"
-  out += "<body>\n"
+  out.append(render_nav(main_dir, title, search))
 
-  out += """
+  if len(pager) > 1:
+    out.append("""
+<div class=\"pager\">
+  Pages: %s
+</div>
+""" % " ".join(
+      ("..." if i is None else
+       "<b>%d</b>" % i if i == page_num else
+       make_link(page, "%d" % i))
+      for i, page in pager))
+
+  out.append("""
 <div class=\"post-head\">
   <table>
-"""
-  for p in posts.values():
-    link = "<a href=\"./%s.html\">%s</a>" % (p[ENUM_INDEX.POST_ID], "%s")
-    out += """
+""")
+  for postid, date, header, tags in rows:
+    link = "<a href=\"./%s.html\">%s</a>" % (postid, "%s")
+    out.append("""
   <tr>
     <td>%s</td>
     <td>%s</td>
     <td>%s</td>
   </tr>
 """ % (
-    (link % p[ENUM_INDEX.POST_DATE]),
-    (link % p[ENUM_INDEX.POST_HEADER]),
-    (", ".join(p[ENUM_INDEX.POST_TAGS].keys())),
-  )
-    # import pdb; pdb.set_trace()
+    (link % date),
+    (link % header),
+    (", ".join(make_link("%s.html" % get_tag_page_name(tag), tag)
+               for tag in tags)),
+  ))
 
-  out += """
+  out.append("""
   </table>
 </div>
-"""
-  out += "</body>"
-  out += "</html>"
-
-  filename = "%s/html/index.html" % (main_dir)
-  with open(filename, 'w+', encoding='utf-8') as f:
-    f.write(out)
+""")
+  out.append("</body>")
+  out.append("</html>")
+  return "".join(out)
+
+
+def make_list_html_pages(main_dir, name, title, rows, page_size, manifest,
+                         force=False, search=False):
+  """
+  Writes the paginated list of posts 'name.html', 'name-p2.html', ...
+  Only the pages whose contents have changed are written. Returns the
+  number of the written pages.
+  """
+  pages = split_into_pages(name, rows, page_size)
+  page_links = [page for page, _ in pages]
+  written = 0
+  for page_num, (page, rows) in enumerate(pages, 1):
+    pager = get_pager(page_links, page_num)
+    source = manifest.get_data_source([title, pager, page_num, rows, search])
+    if not force and manifest.is_up_to_date(page, source):
+      continue
+
+    filename = "%s/html/%s" % (main_dir, page)
+    with open(filename, 'w', encoding='utf-8') as f:
+      f.write(render_list_page(main_dir, title, rows, pager, page_num,
+                               search))
+    manifest.set_page(page, source)
+    written += 1
+  return written
+
+
+def make_archive_html_page(main_dir, months, tags, manifest, force=False,
+                           search=False):
+  """
+  Writes 'archive.html' with the links to the pages of the years, months
+  and tags.
+  """
+  years = {}
+  for month, month_rows in months.items():
+    years.setdefault(month[:4], []).append((month, len(month_rows)))
+  tag_counts = sorted((tag, len(tag_rows)) for tag, tag_rows in tags.items())
+
+  source = manifest.get_data_source(
+      [sorted(years.items()), tag_counts, search])
+  if not force and manifest.is_up_to_date("archive.html", source):
+    return 0
+
+  out = []
+  out.append("<!DOCTYPE HTML>\n")
+  out.append("<html><head>\n")
+  out.append("<meta charset=\"utf-8\">\n")
+  out.append("<title>%s: Archive</title>\n" % main_dir)
+  out.append("</head>\n")
+  out.append("<body>\n")
+  out.append(render_nav(main_dir, "Archive", search))
+
+  out.append("""
+<div class=\"archive-years\">
+  <table>
+""")
+  for year, year_months in sorted(years.items()):
+    out.append("""
+  <tr>
+    <td>%s (%d)</td>
+    <td>%s</td>
+  </tr>
+""" % (
+    make_link("archive-%s.html" % year, year),
+    sum(count for _, count in year_months),
+    ", ".join("%s (%d)" % (make_link("archive-%s.html" % month, month[5:]),
+                           count)
+              for month, count in sorted(year_months)),
+  ))
+  out.append("""
+  </table>
+</div>
+""")
 
-  print("Index HTML file '%s' has been generated successfully" % filename)
+  if tag_counts:
+    out.append("""
+<div class=\"archive-tags\">
+  Tags: %s
+</div>
+""" % ", ".join("%s (%d)" % (make_link("%s.html" % get_tag_page_name(tag), tag),
+                            count)
+                for tag, count in tag_counts))
+
+  out.append("</body>")
+  out.append("</html>")
+
+  filename = "%s/html/archive.html" % main_dir
+  with open(filename, 'w', encoding='utf-8') as f:
+    f.write("".join(out))
+  manifest.set_page("archive.html", source)
+  return 1
+
+
+def make_index_html_pages(main_dir, posts, manifest, page_size=100,
+                          force=False, search=False):
+  """
+  Writes the paginated index of all the posts sorted by date and the
+  archive: the pages of every year, month and tag. All of them are made
+  from one list of posts sorted once.
+  """
+  # [ (postid, date, header, tags) ] sorted by date
+  rows = [
+    (p[ENUM_INDEX.POST_ID], p[ENUM_INDEX.POST_DATE],
+     p[ENUM_INDEX.POST_HEADER], list(p[ENUM_INDEX.POST_TAGS].keys()))
+    for p in sorted(posts.values(), key=get_post_sort_key)
+  ]
+
+  years = {}
+  months = {}
+  tags = {}
+  for row in rows:
+    date = row[1] or ""
+    if len(date) >= 7:
+      years.setdefault(date[:4], []).append(row)
+      months.setdefault(date[:7], []).append(row)
+    for tag in row[3]:
+      tags.setdefault(tag, []).append(row)
+
+  written = make_list_html_pages(main_dir, "index", main_dir, rows,
+                                 page_size, manifest, force, search)
+  for year, year_rows in years.items():
+    written += make_list_html_pages(
+        main_dir, "archive-%s" % year, year, year_rows, page_size, manifest,
+        force, search)
+  for month, month_rows in months.items():
+    written += make_list_html_pages(
+        main_dir, "archive-%s" % month, month, month_rows, page_size,
+        manifest, force, search)
+  for tag, tag_rows in tags.items():
+    written += make_list_html_pages(
+        main_dir, get_tag_page_name(tag), "Tag: %s" % tag, tag_rows,
+        page_size, manifest, force, search)
+  written += make_archive_html_page(main_dir, months, tags, manifest, force,
+                                    search)
+
+  print("Index HTML files in '%s/html' have been generated successfully "
+        "(%d page(s) written)" % (main_dir, written))
   return 0
 
 
-def make_post_html_page(main_dir, postid):
+def iter_post_comments(fdata):
+  with open(fdata, "r", encoding='utf-8') as f:
+    for key, value in iter_json_object(f, ENUM_POST.COMMENTS):
+      if key == ENUM_POST.COMMENTS:
+        yield value
+
+
+def load_post(main_dir, postid, db=None):
+  """
+  Returns the post without its comments, the number of the comments and a
+  function iterating over them, so the comments of a huge post are read one
+  by one while they are rendered.
+  """
+  if db is not None:
+    jdata = db.get_post(postid, with_comments=False)
+    if jdata is None:
+      print("Error: post '%s' is not in the database" % postid)
+      return None
+    return (jdata, db.get_comment_count(postid),
+            lambda: db.iter_comments(postid))
+
   fdata = "%s/%s.data" % (main_dir, postid)
   if not os.path.isfile(fdata):
     print("Error: file '%s' doesn't exist" % fdata)
+    return None
+
+  if os.path.getsize(fdata) < STREAM_MIN_SIZE:
+    with open(fdata, "r", encoding='utf-8') as f:
+      jdata = json.load(f)
+    comments = jdata.pop(ENUM_POST.COMMENTS)
+    return jdata, len(comments), lambda: iter(comments)
+
+  # the comments are saved before the date and the text of the post, so the
+  #   file is read twice: first the post is read skipping the comments, then
+  #   the comments are read while they are rendered
+  jdata = {}
+  comment_count = 0
+  with open(fdata, "r", encoding='utf-8') as f:
+    for key, value in iter_json_object(f, ENUM_POST.COMMENTS):
+      if key == ENUM_POST.COMMENTS:
+        comment_count += 1
+      else:
+        jdata[key] = value
+  return jdata, comment_count, lambda: iter_post_comments(fdata)
+
+
+def make_post_html_page(main_dir, postid, db=None):
+  post = load_post(main_dir, postid, db)
+  if post is None:
     return 1
 
-  with open(fdata, "r", encoding='utf-8') as f:
-    jdata = json.load(f)
+  jdata, comment_count, iter_comments = post
 
-    out = "<!DOCTYPE HTML>\n"
-    out += "<html><head>\n"
-    out += "<meta charset=\"utf-8\">\n"
-    out += "<title>%s</title>\n" % jdata[ENUM_POST.HEADER]
-    out += """<style type=\"text/css\">
+  out = "<!DOCTYPE HTML>\n"
+  out += "<html><head>\n"
+  out += "<meta charset=\"utf-8\">\n"
+  out += "<title>%s</title>\n" % jdata[ENUM_POST.HEADER]
+  out += """<style type=\"text/css\">
   .post-head {
     background: #BFEFFF;
     border: solid 0px black;
@@ -161,10 +437,29 @@ def make_post_html_page(main_dir, postid):
 <div class=\"post-comments\" >
   %d Comments
 </div>
-""") % (len(jdata[ENUM_POST.COMMENTS]))
+""") % (comment_count)
+
+  # the page is written while the comments are being rendered, so the memory
+  #   used does not depend on the number of comments
+  filename = "%s/html/%s.html" % (main_dir, postid)
+  tmp_filename = filename + ".tmp"
+  with open(tmp_filename, 'w', encoding='utf-8') as f:
+    f.write(out)
+    f.writelines(render_comments(jdata, iter_comments()))
+    f.write("</body>")
+    f.write("</html>")
+  os.replace(tmp_filename, filename)
 
+  print("HTML file '%s' has been generated successfully" % filename)
+  return 0
+
+
+def render_comments(jdata, comments):
+  """
+  Renders the comments of a post one by one.
+  """
   thread_levels = []           # [  (thread_id, thread_level)  ]
-  for comm in jdata[ENUM_POST.COMMENTS]:
+  for comm in comments:
 
     thread_above = comm[ENUM_COM.ABOVE]
     thread_level = int(comm[ENUM_COM.LEVEL])
@@ -196,7 +491,7 @@ def make_post_html_page(main_dir, postid):
       print("Warning: user '%s' does not have userpic!" % comm[ENUM_COM.USER])
 
     offset = thread_level * 20
-    out += ( """
+    yield ( """
 <div style=\"border: solid 0px black; padding: 2px; padding-left: %dpx; \">
   <table>
   <tr><td>
@@ -229,27 +524,156 @@ def make_post_html_page(main_dir, postid):
          comm[ENUM_COM.USER], comm[ENUM_COM.DATE], comm[ENUM_COM.THREADURL],
          comm[ENUM_COM.TEXT])
 
-  out += "</body>"
-  out += "</html>"
+def make_search_index(main_dir, posts, sources, manifest, db=None,
+                      force=False):
+  """
+  Builds the search index of the posts and their comments and writes its
+  shards (only the changed ones) and the search page. The terms of every
+  post are cached with the hash of its source (see `sources`), so only the
+  posts which have changed are read again.
+  """
+  search_dir = "%s/html/%s" % (main_dir, SEARCH_DIR)
+  if not os.path.exists(search_dir):
+    os.makedirs(search_dir)
+
+  cache_file = "%s/%s" % (search_dir, SEARCH_CACHE)
+  cache = {}    # { postid: [source hash, date, header, terms] }
+  if os.path.isfile(cache_file) and not force:
+    with open(cache_file, 'r', encoding='utf-8') as f:
+      cache = json.load(f)
+
+  builder = SearchIndexBuilder()
+  read = 0
+  for postid in posts:
+    source = sources.get("%s.html" % postid)
+    cached = cache.get(postid)
+    if (cached is None or source is None or
+        cached[0] != source['hash']):
+      post = load_post(main_dir, postid, db)
+      if post is None:
+        cache.pop(postid, None)
+        continue
+      jdata, _, iter_comments = post
+      cached = cache[postid] = [
+        source['hash'] if source else None,
+        jdata.get(ENUM_POST.DATE), jdata.get(ENUM_POST.HEADER),
+        count_post_terms(
+          jdata.get(ENUM_POST.HEADER), jdata.get(ENUM_POST.TAGS) or {},
+          jdata.get(ENUM_POST.TEXT),
+          (comm[ENUM_COM.TEXT] for comm in iter_comments())),
+      ]
+      read += 1
+    builder.add_post(postid, cached[1], cached[2], cached[3])
+
+  for postid in set(cache) - set(posts):
+    del cache[postid]
+  if read or len(cache) != len(posts):
+    tmp_file = cache_file + ".tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+      json.dump(cache, f, ensure_ascii=False)
+    os.replace(tmp_file, cache_file)
+
+  files = builder.get_files()
+  files["search.html"] = render_search_page(main_dir)
+
+  written = 0
+  for name, contents in files.items():
+    page = name if name == "search.html" else "%s/%s" % (SEARCH_DIR, name)
+    source = manifest.get_data_source(contents)
+    if not force and manifest.is_up_to_date(page, source):
+      continue
+    with open("%s/html/%s" % (main_dir, page), 'w', encoding='utf-8') as f:
+      f.write(contents)
+    manifest.set_page(page, source)
+    written += 1
+
+  print("Search index '%s' has been generated successfully (%d post(s) "
+        "read, %d terms, %d file(s) written)" % (
+          search_dir, read, len(builder.terms), written))
+  return 0
 
-  filename = "%s/html/%s.html" % (main_dir, postid)
-  with open(filename, 'w+', encoding='utf-8') as f:
-    f.write(out)
 
-  print("HTML file '%s' has been generated successfully" % filename)
-  return 0
+# state of a rendering process, see init_worker
+worker_main_dir = None
+worker_db = None
+
+
+def init_worker(main_dir, use_db):
+  global worker_main_dir, worker_db
+  worker_main_dir = main_dir
+  worker_db = PostDatabase(main_dir) if use_db else None
+
+
+def render_post(postid):
+  """
+  Renders one post in a rendering process and returns the error message if
+  it has failed, so one broken post does not stop the others.
+  """
+  try:
+    if make_post_html_page(worker_main_dir, postid, worker_db) != 0:
+      return "see the error above"
+  except Exception:
+    return traceback.format_exc()
+  return None
+
+
+def make_post_html_pages(main_dir, postids, jobs=1, use_db=False):
+  """
+  Renders the posts in 'jobs' processes and returns the ones which failed.
+  """
+  failed = []
+  if jobs <= 1:
+    init_worker(main_dir, use_db)
+    for postid in postids:
+      err = render_post(postid)
+      if err:
+        failed.append((postid, err))
+    if worker_db is not None:
+      worker_db.close()
+    return failed
+
+  # posts are handed out in small batches, so a few huge posts at the end
+  #   do not keep one process busy while the others are idle
+  chunksize = max(1, min(16, len(postids) // (jobs * 8)))
+  with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                           initargs=(main_dir, use_db)) as executor:
+    for postid, err in zip(postids, executor.map(render_post, postids,
+                                                 chunksize=chunksize)):
+      if err:
+        failed.append((postid, err))
+  return failed
+
 
 # MAIN
 if __name__=='__main__':
-  if len(sys.argv) < 2:
-    print("Error: Too few params")
-    exit(1)
-
-  ljuser = sys.argv[1]
-  fdata = ljuser + "/index.data"
-  if not os.path.isfile(fdata):
-    print("Error: file '%s' doesn't exist" % fdata)
-    exit(1)
+  parser = argparse.ArgumentParser(
+      description='Creates HTML pages based on the downloaded posts.')
+  parser.add_argument('ljuser', help='name of the downloaded journal')
+  parser.add_argument('--db', action='store_true',
+      help="render the posts from the database '<ljuser>/%s' instead of "
+           "the json files" % PostDatabase.FILENAME)
+  parser.add_argument('-j', '--jobs', type=int, default=1,
+      help='number of processes rendering posts (default: %(default)s)')
+  parser.add_argument('--page-size', type=int, default=100,
+      help='number of posts on one index page (default: %(default)s)')
+  parser.add_argument('--search', action='store_true',
+      help='build the search index of the posts and comments')
+  parser.add_argument('-f', '--force', action='store_true',
+      help='render all the pages, even the ones which are up to date')
+  args = parser.parse_args()
+
+  ljuser = args.ljuser
+  if args.db:
+    fdata = "%s/%s" % (ljuser, PostDatabase.FILENAME)
+    if not os.path.isfile(fdata):
+      print("Error: file '%s' doesn't exist" % fdata)
+      exit(1)
+  else:
+    fdata = "%s/%s" % (ljuser, PostIndex.LOG)
+    if (not os.path.isfile(fdata) and
+        not os.path.isfile("%s/%s" % (ljuser, PostIndex.LEGACY))):
+      print("Error: file '%s' doesn't exist" % fdata)
+      exit(1)
 
   html_dir = "%s/html/" % ljuser
   if not os.path.exists(html_dir):
@@ -266,15 +690,58 @@ if __name__=='__main__':
       else:
         print("Error: file './%s' doesn't exist" % picture_file)
 
-  with open(fdata, "r", encoding='utf-8') as f:
-    jdata = json.load(f)
+  manifest = BuildManifest(html_dir.rstrip('/'), RENDERER_VERSION)
+  if args.db:
+    db = PostDatabase(ljuser)
+    index_posts = db.get_index_posts()
+    post_hashes = db.get_post_hashes()
+    db.close()
+  else:
+    # lj-dl.py may be appending to the index, so it is left as it is
+    index_posts = PostIndex(ljuser).load(read_only=True).posts
 
   # sort posts by creation time
-  jdata[ENUM_INDEX.POSTS] = {
-    p : jdata[ENUM_INDEX.POSTS][p] for p in sorted(jdata[ENUM_INDEX.POSTS])
-  }
-
-  make_index_html_page(ljuser, jdata[ENUM_INDEX.POSTS])
-
-  for p in jdata[ENUM_INDEX.POSTS].values():
-    make_post_html_page(ljuser, p[ENUM_INDEX.POST_ID])
+  posts = { p : index_posts[p] for p in sorted(index_posts) }
+
+  # only the posts which have changed since the last run are rendered
+  sources = {}
+  for postid in posts:
+    page = "%s.html" % postid
+    if args.db:
+      sources[page] = {'hash': post_hashes[postid]}
+    else:
+      sources[page] = manifest.get_file_source(
+          page, "%s/%s.data" % (ljuser, postid))
+  postids = [
+    p for p in posts
+    if args.force or not manifest.is_up_to_date("%s.html" % p,
+                                                sources["%s.html" % p])
+  ]
+  print("%d of %d post(s) have changed" % (len(postids), len(posts)))
+
+  failed = make_post_html_pages(ljuser, postids, jobs=args.jobs,
+                                use_db=args.db)
+
+  failed_postids = set(postid for postid, _ in failed)
+  for page, source in sources.items():
+    if source is not None and page[:-len(".html")] not in failed_postids:
+      manifest.set_page(page, source)
+
+  if args.search:
+    db = PostDatabase(ljuser) if args.db else None
+    make_search_index(ljuser, posts, sources, manifest, db=db,
+                      force=args.force)
+    if db is not None:
+      db.close()
+
+  make_index_html_pages(ljuser, posts, manifest,
+                        page_size=max(1, args.page_size), force=args.force,
+                        search=args.search)
+  manifest.save()
+
+  if failed:
+    for postid, err in failed:
+      print("Error: rendering post %s failed: %s" % (postid, err.rstrip()))
+    print("Error: %d post(s) failed: %s" % (
+        len(failed), " ".join(postid for postid, _ in failed)))
+    exit(2)
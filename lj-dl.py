@@ -1,11 +1,11 @@
 # -*- coding: utf-8 -*-
 
+import argparse
 import asyncio
 import datetime
 
 import json
 import logging
-import time
 import os
 import re
 import sys
@@ -16,25 +16,38 @@ from html.parser import HTMLParser
 
 import helpers
 from constants import (ENUM_INDEX, ENUM_POST, ENUM_COM, ENUM_ASYNC_TASK_STATUS)
-from download_helpers import (FileDownloader, ContentDownloader)
+from download_helpers import (FileDownloader, ContentDownloader, HttpClient)
+from index_helpers import PostIndex
+from db_helpers import PostDatabase
+from parse_helpers import extract_json_contents
+from store_helpers import (ImageStore, PostCheckpoint, UserpicStore)
 
 
-ANSW_NO  = 0
-ANSW_YES = 1
-ANSW_ASK = 2
+ANSW_NO     = 0
+ANSW_YES    = 1
+ANSW_ASK    = 2
+ANSW_UPDATE = 3
 
 OPT_REWRITE_POSTS_EXISTING = ANSW_ASK
 
+confirm_lock = asyncio.Lock()
+
 
 class AbstractFileDownloader():
 
   MAX_CONNECTIONS_DEFAULT = 5
+  FILE_ID_MARK_PATTERN = re.compile('##(\d+)##')
 
-  def __init__(self, main_dir):
+  def __init__(self, main_dir, client=None):
     self.downloader = FileDownloader()
+    self.client = client
+    self.semaphore = asyncio.Semaphore(self.MAX_CONNECTIONS_DEFAULT)
+    self.download_tasks = []
     self.files = {}
     self.files_to_download = {}
     self.urls_to_download = {}
+    self.existing_files = {}
+    self.links = None
     self.main_dir = main_dir
 
   def generate_next_file_id(self):
@@ -49,49 +62,76 @@ class AbstractFileDownloader():
 
     filename, existing = self.compose_filename(url)
     if existing:
-      return filename
+      self.existing_files[url] = filename
+      return self.compose_link_to_file(filename)
 
     file_id = self.generate_next_file_id()
     self.files_to_download[file_id] = (url, filename)
     self.urls_to_download[url] = file_id
+    self.files[file_id] = filename
+    self.links = None
+
+    # start downloading right away, so files are fetched while the comments
+    #   are still being crawled
+    self.download_tasks.append(asyncio.ensure_future(
+        self.download_file(url, filename)))
     return file_id
 
+  async def download_file(self, url, filename):
+    dest = '%s/%s' % (self.main_dir, filename)
+    return await self.downloader.download_file(
+        url, dest, self.semaphore, self.client)
+
   def get_filename_by_id(self, file_id):
     return self.files[file_id]
 
+  async def cancel_downloads(self):
+    """
+    Cancels the planned downloads of a post which is abandoned, the files
+    shared with other posts through a store are still downloaded for them.
+    """
+    for task in self.download_tasks:
+      task.cancel()
+    if self.download_tasks:
+      await asyncio.gather(*self.download_tasks, return_exceptions=True)
+    self.download_tasks = []
+
   def get_fallback_filename(self):
     raise NotImplementedError
 
-  def download_files(self):
-    urls = {}
-    for file_id, (url, filename) in self.files_to_download.items():
-      urls[url] = '%s/%s' % (self.main_dir, filename)
-      self.files[file_id] = '%s' % (filename)
-
-    if not urls:
+  def get_files(self):
+    """
+    Returns the table { url: filename } of the files the texts link to,
+    the files which failed to download are left out.
+    """
+    files = dict(self.existing_files)
+    for file_id, (url, _) in self.files_to_download.items():
+      filename = self.files[file_id]
+      if filename is not None and filename != self.get_fallback_filename():
+        files[url] = filename
+    return files
+
+  async def download_files(self):
+    """
+    Waits until all the planned files are downloaded and replaces the files
+    which failed to download with the fallback one.
+    """
+    if not self.download_tasks:
       return
 
-    if sys.version_info >= (3, 7):
-      done, pending = asyncio.run(
-          self.downloader.download_files_asynchronously(
-              urls, max_connections=self.MAX_CONNECTIONS_DEFAULT))
-    elif sys.version_info >= (3, 5):
-      loop = asyncio.get_event_loop()
-      done, pending = loop.run_until_complete(
-          self.downloader.download_files_asynchronously(
-              urls, max_connections=self.MAX_CONNECTIONS_DEFAULT))
-    else:
-      assert False, "Your Python version is not support"
+    done, pending = await asyncio.wait(self.download_tasks)
+    self.download_tasks = []
 
     for task in done:
       code, url, dest = task.result()
       if code != 200:
         file_id = self.urls_to_download[url]
         self.files[file_id] = self.get_fallback_filename()
+    self.links = None
 
   @staticmethod
   def get_file_id_mark_regex():
-    return '##(\d+)##'
+    return AbstractFileDownloader.FILE_ID_MARK_PATTERN.pattern
 
   def compose_link_to_file(self, filename):
     raise NotImplementedError
@@ -100,36 +140,34 @@ class AbstractFileDownloader():
   def make_file_id_mark_by_id(file_id):
     return '##{}##'.format(file_id)
 
+  def get_links_by_id(self):
+    """
+    Returns the table { file id: link to the file } which is built once all
+    the files have been downloaded.
+    """
+    if self.links is None:
+      self.links = {
+          file_id: self.compose_link_to_file(filename)
+          for file_id, filename in self.files.items()
+      }
+    return self.links
+
   def decode_filenames_in_text(self, text):
     if not text:
       return text
 
-    file_ids = []
-    m_list = re.findall(AbstractFileDownloader.get_file_id_mark_regex(),
-                        text, re.MULTILINE)
-    if not m_list:
-      return text
-
-    for m in m_list:
-      file_id = AbstractFileDownloader.make_file_id_mark_by_id(m)
-      filename = self.compose_link_to_file(self.get_filename_by_id(file_id))
-      text = text.replace(file_id, filename)
-
-    return text
+    links = self.get_links_by_id()
+    return self.FILE_ID_MARK_PATTERN.sub(lambda m: links[m.group(0)], text)
 
 
 class ImageDownloader(AbstractFileDownloader):
 
   NO_PICTURE = '../../no-picture.svg" width="50" height="50'
 
-  def __init__(self, main_dir, sub_dir):
-    AbstractFileDownloader.__init__(self, main_dir)
-    self.num_files = -1
-    self.sub_dir = sub_dir
-    self.file_dir = "./{main_dir}/{sub_dir}".format(
-        main_dir=main_dir, sub_dir=sub_dir)
-    if not os.path.exists(self.file_dir):
-      os.makedirs(self.file_dir)
+  def __init__(self, main_dir, store, checkpoint, client=None):
+    AbstractFileDownloader.__init__(self, main_dir, client)
+    self.store = store
+    self.checkpoint = checkpoint
 
   def compose_link_to_file(self, filename):
     return '../{}'.format(filename)
@@ -137,7 +175,8 @@ class ImageDownloader(AbstractFileDownloader):
   def get_fallback_filename(self):
     return self.NO_PICTURE
 
-  def compose_filename(self, url):
+  @staticmethod
+  def get_file_ext(url):
     fileext = ''
     m = re.search(".+\.(.+)$", url, re.MULTILINE)
     if m is None:
@@ -147,9 +186,23 @@ class ImageDownloader(AbstractFileDownloader):
 
     if len(fileext) > 5 or '/' in fileext or '.' in fileext[1:]:
       fileext = '.xxx'
+    return fileext
+
+  def compose_filename(self, url):
+    filename = self.store.get_filename(url)
+    if filename is not None:
+      return filename, True
+
+    # the real name is known once the file is downloaded and hashed
+    return None, False
 
-    self.num_files += 1
-    return '%s/file%d%s' % (self.sub_dir, self.num_files, fileext), False
+  async def download_file(self, url, filename):
+    code, filename = await self.store.download(
+        url, self.get_file_ext(url), self.semaphore, self.client)
+    if code == 200:
+      self.files[self.urls_to_download[url]] = filename
+      self.checkpoint.add_file(url, filename)
+    return code, url, filename
 
 
 class UserpicDownloader(AbstractFileDownloader):
@@ -157,11 +210,11 @@ class UserpicDownloader(AbstractFileDownloader):
   NO_USERPIC = 'userpic-user.png'
   USERPIC_DIR = 'userpics'
 
-  def __init__(self, main_dir):
-    AbstractFileDownloader.__init__(self, main_dir)
+  def __init__(self, main_dir, store, client=None):
+    AbstractFileDownloader.__init__(self, main_dir, client)
+    self.store = store
     self.file_dir = "./{main_dir}".format(main_dir=main_dir)
-    if not os.path.exists(self.file_dir):
-      os.makedirs(self.file_dir)
+    self.userpic_dir = '%s/%s' % (self.file_dir, self.USERPIC_DIR)
 
   def get_fallback_filename(self):
     return '%s/%s' % (self.USERPIC_DIR, self.NO_USERPIC)
@@ -169,6 +222,10 @@ class UserpicDownloader(AbstractFileDownloader):
   def compose_link_to_file(self, filename):
     return filename
 
+  @classmethod
+  def get_userpic_key(cls, filename):
+    return filename[len(cls.USERPIC_DIR):].lstrip('/')
+
   def compose_filename(self, url):
     user_dir = user_pic = None
 
@@ -185,14 +242,23 @@ class UserpicDownloader(AbstractFileDownloader):
       user_dir = m.group(1)
       user_pic = m.group(2)
 
-    subdir = '%s/%s/%s' % (self.file_dir, self.USERPIC_DIR, user_dir)
-    if not os.path.exists(subdir):
-      os.makedirs(subdir)
-
-    filename = '%s/%s/%s/%s' % (
-        self.file_dir, self.USERPIC_DIR, user_dir, user_pic)
     rel_filename = '%s/%s/%s' % (self.USERPIC_DIR, user_dir, user_pic)
-    return rel_filename, os.path.isfile(filename)
+    key = self.get_userpic_key(rel_filename)
+    if self.store.is_linked(self.userpic_dir, key):
+      return rel_filename, True
+
+    if self.store.has(key):
+      self.store.link(self.userpic_dir, key)
+      return rel_filename, True
+
+    return rel_filename, False
+
+  async def download_file(self, url, filename):
+    key = self.get_userpic_key(filename)
+    code = await self.store.download(url, key, self.semaphore, self.client)
+    if code == 200:
+      self.store.link(self.userpic_dir, key)
+    return code, url, '%s/%s' % (self.main_dir, filename)
 
 
 class LJPostParser(HTMLParser):
@@ -206,6 +272,15 @@ class LJPostParser(HTMLParser):
     self.state = []
     self.post = post
     self.downloader = downloader
+    self.buffers = {}  # { post field: [text fragments] }
+
+  def finish(self):
+    """
+    Joins the collected text fragments into the post fields. It is called
+    once the whole page has been fed, so a long text is built only once.
+    """
+    for field, fragments in self.buffers.items():
+      self.post[field] = ''.join(fragments)
 
   def _set_state(self, new_state):
       self.state.append(new_state)
@@ -223,14 +298,15 @@ class LJPostParser(HTMLParser):
             self._pop_state()
             return
       # include given tag
-      self.post[ENUM_POST.TEXT] += ('<%s ' % tag)
+      text = self.buffers[ENUM_POST.TEXT]
+      text.append('<%s ' % tag)
       for k, v in attrs:
         # images
         if tag == 'img' and k == 'src':
           v = self.downloader.plan_to_download(v)
 
-        self.post[ENUM_POST.TEXT] += '%s = "%s" ' % (k, v)
-      self.post[ENUM_POST.TEXT] += '>'
+        text.append('%s = "%s" ' % (k, v))
+      text.append('>')
       return
 
     # handle tags
@@ -248,7 +324,7 @@ class LJPostParser(HTMLParser):
           self.post[ENUM_POST.COMPAGES].append(v)
     elif tag == 'time':
       self._set_state(self.PS_DATE)
-      self.post[ENUM_POST.DATE] = ''
+      self.buffers[ENUM_POST.DATE] = []
     elif tag == 'article':
       if attrs and len(attrs) > 0:
         k, v = attrs[0]
@@ -257,7 +333,7 @@ class LJPostParser(HTMLParser):
             re.search('aentry-post__text aentry-post__text--view', v)
             )):
           self._set_state(self.PS_TEXT)
-          self.post[ENUM_POST.TEXT] = ''
+          self.buffers[ENUM_POST.TEXT] = []
     elif tag == 'meta':
       if attrs and len(attrs) > 1:
         k0, v0 = attrs[0]
@@ -274,7 +350,7 @@ class LJPostParser(HTMLParser):
       elif tag == 'br':
         pass
       else:
-        self.post[ENUM_POST.TEXT] += (' </%s> ' % tag)
+        self.buffers[ENUM_POST.TEXT].append(' </%s> ' % tag)
       return
 
     # handle tags
@@ -288,9 +364,9 @@ class LJPostParser(HTMLParser):
     if len(self.state) == 0: return
 
     if self.state[-1] == self.PS_TEXT:
-      self.post[ENUM_POST.TEXT] += data
+      self.buffers[ENUM_POST.TEXT].append(data)
     elif self.state[-1] == self.PS_DATE:
-      self.post[ENUM_POST.DATE] += data
+      self.buffers[ENUM_POST.DATE].append(data)
 
 
 class LJCommentParser(HTMLParser):
@@ -298,25 +374,32 @@ class LJCommentParser(HTMLParser):
     HTMLParser.__init__(self)
     self.comment    = comment
     self.downloader = downloader
+    self.text       = [comment[ENUM_COM.TEXT]]
+
+  def finish(self):
+    """
+    Joins the collected text fragments into the comment text.
+    """
+    self.comment[ENUM_COM.TEXT] = ''.join(self.text)
 
   def handle_starttag(self, tag, attrs):
     # include given tag
-    self.comment[ENUM_COM.TEXT] += "<%s " % tag
+    self.text.append("<%s " % tag)
     for k, v in attrs:
       # images
       if tag == 'img' and k == 'src':
         v = self.downloader.plan_to_download(v)
 
-      self.comment[ENUM_COM.TEXT] += '%s ="%s" ' % (k, v)
-    self.comment[ENUM_COM.TEXT] += '>'
+      self.text.append('%s ="%s" ' % (k, v))
+    self.text.append('>')
 
   def handle_endtag(self, tag):
     if tag == 'br':
       return
-    self.comment[ENUM_COM.TEXT] += ' </%s> ' % tag
+    self.text.append(' </%s> ' % tag)
 
   def handle_data(self, data):
-    self.comment[ENUM_COM.TEXT] += data
+    self.text.append(data)
 
 
 class AsyncTaskNode():
@@ -326,6 +409,8 @@ class AsyncTaskNode():
     self.children = []
     self.result = None
     self.data = data
+    self.attempts = 0
+    self.delay = 0
 
   def get_state(self):
     raise NotImplementedError
@@ -342,53 +427,84 @@ class AsyncTaskNode():
 
 class AsyncTaskProcessor():
 
-  def __init__(self):
+  def __init__(self, retry_policy=None):
     self.task_queue = OrderedDict()
     self.root_task = AsyncTaskNode(None)
+    # a task which failed although its requests were retried is planned
+    #   again as long as the retry policy allows it
+    self.retry_policy = retry_policy
+    self.requeued = 0
 
-  async def run_tasks_asynchronously(self, async_tasks_data):
+  async def run_task_asynchronously(self, async_task_data):
     raise NotImplementedError
 
-  def handle_task_result(self, task):
-    raise NotImplementedError
+  async def _run_task(self, task):
+    task.attempts += 1
+    if task.delay:
+      await asyncio.sleep(task.delay)
+    return await self.run_task_asynchronously(task.get_async_task_data())
 
-  def run(self):
-    round_needed = True
-    while round_needed:
-      round_needed = self.run_round()
-
-  def run_round(self):
-    async_tasks_data = {}
-    for task_id in self.task_queue.keys():
-      task = self.task_queue[task_id]
-      task.status = ENUM_ASYNC_TASK_STATUS.PROCESSING
-      async_tasks_data[task_id] = None
-
-    if sys.version_info >= (3, 7):
-      done, pending = asyncio.run(
-          self.run_tasks_asynchronously(async_tasks_data.keys()))
-    elif sys.version_info >= (3, 5):
-      loop = asyncio.get_event_loop()
-      done, pending = loop.run_until_complete(
-          self.run_tasks_asynchronously(async_tasks_data.keys()))
-    else:
-      assert False, "Your Python version is not support"
+  def is_task_failed(self, code, result):
+    """
+    Returns whether a task has failed for a reason which may go away, so it
+    is worth running it again.
+    """
+    return result is None and (
+        code is None or code < 0 or self.retry_policy.is_retryable(code))
 
-    for task_result in done:
-      result = task_result.result()
-      if len(result) == 1:
-        logging.error('Error: Coroutine failed: %s', task_result)
-      else:
-        code, task_id, result = result
-        task = self.task_queue[task_id]
-        task.status = ENUM_ASYNC_TASK_STATUS.FINISHED
-        task.set_result(result)
+  def handle_task_result(self, task):
+    raise NotImplementedError
 
-    tasks = self.task_queue
-    self.task_queue = OrderedDict()
-    for task in tasks.values():
-      self.handle_task_result(task)
-    return len(self.task_queue) > 0
+  async def run(self):
+    """
+    Runs planned tasks until there is nothing left to do. A task is started
+    as soon as it is planned, and its result is handled as soon as it is
+    ready, so tasks planned by the handler don't wait for their siblings.
+    """
+    running = OrderedDict()   # { future: task }
+    try:
+      while self.task_queue or running:
+        for task in self.task_queue.values():
+          task.status = ENUM_ASYNC_TASK_STATUS.PROCESSING
+          future = asyncio.ensure_future(self._run_task(task))
+          running[future] = task
+        self.task_queue = OrderedDict()
+
+        done, pending = await asyncio.wait(
+            running.keys(), return_when=asyncio.FIRST_COMPLETED)
+
+        # handle finished tasks in the order they were started
+        for future in [f for f in running if f in done]:
+          task = running.pop(future)
+          if future.exception() is not None:
+            logging.error('Error: Coroutine failed: %s (%s)',
+                          task.get_async_task_data(), future.exception())
+            code, result = None, None
+          else:
+            code, task_id, result = future.result()
+
+          if (self.retry_policy is not None and
+              self.is_task_failed(code, result) and
+              self.retry_policy.can_retry(task.attempts)):
+            task.delay = self.retry_policy.get_delay(task.attempts)
+            self.retry_policy.add_retry()
+            logging.warning("Warning: Task '%s' failed (%s), planned it again "
+                            "in %.1f seconds", task.get_async_task_data(), code,
+                            task.delay)
+            self.requeued += 1
+            task.status = ENUM_ASYNC_TASK_STATUS.PLANNED
+            self.task_queue[task.get_async_task_data()] = task
+            continue
+
+          task.status = ENUM_ASYNC_TASK_STATUS.FINISHED
+          task.set_result(result)
+          self.handle_task_result(task)
+    finally:
+      # a handler which raised leaves the tasks which are still running
+      for future in running:
+        future.cancel()
+      if running:
+        await asyncio.gather(*running, return_exceptions=True)
 
   @staticmethod
   def create_task(task_data):
@@ -428,16 +544,52 @@ class CommentTaskProcessor(AsyncTaskProcessor):
 
   MAX_CONNECTIONS_DEFAULT = 4
 
-  def __init__(self, image_downloader, userpic_downloader):
-    AsyncTaskProcessor.__init__(self)
+  def __init__(self, image_downloader, userpic_downloader, checkpoint,
+               client=None):
+    AsyncTaskProcessor.__init__(
+        self, client.retry_policy if client is not None else None)
     self.content_downloader = ContentDownloader()
+    self.semaphore = asyncio.Semaphore(self.MAX_CONNECTIONS_DEFAULT)
+    self.client = client
     self.image_downloader = image_downloader
     self.userpic_downloader = userpic_downloader
+    self.checkpoint = checkpoint
     self.comment_ids = {}
-
-  async def run_tasks_asynchronously(self, comment_thread_urls):
-    return await self.content_downloader.download_content_asynchronously(
-        comment_thread_urls, max_connections=self.MAX_CONNECTIONS_DEFAULT)
+    self.pages = {}
+
+  def add_page(self, comment_thread_url, json_comments):
+    """
+    Adds the comments of a page which has been fetched already (the page of
+    the post), so the page is not downloaded again.
+    """
+    self.pages[comment_thread_url] = json_comments
+
+  async def run_task_asynchronously(self, comment_thread_url):
+    """
+    Returns the comments of the thread page as they are in its json content,
+    taking them from the checkpoint or the added pages if the page has been
+    fetched already.
+    """
+    json_comments = self.checkpoint.get_thread(comment_thread_url)
+    if json_comments is not None:
+      return 200, comment_thread_url, json_comments
+
+    json_comments = self.pages.pop(comment_thread_url, None)
+    if json_comments is not None:
+      logging.info("Taking the comments of '%s' from the post page",
+                   comment_thread_url)
+      return 200, comment_thread_url, json_comments
+
+    code, url, contents = (
+        await self.content_downloader.download_json_contents(
+            comment_thread_url, ('page',), self.semaphore, self.client))
+    if contents is None:
+      return code, url, None
+
+    json_comments = contents.get('page', {}).get('comments')
+    if json_comments is not None:
+      self.checkpoint.add_thread(comment_thread_url, json_comments)
+    return code, url, json_comments
 
   @staticmethod
   def create_task(task_data):
@@ -468,8 +620,7 @@ class CommentTaskProcessor(AsyncTaskProcessor):
     return comments
 
   def extract_comments(self, task):
-    json_contents = extract_json_contents(task.result)
-    json_comments = json_contents['page'].get('comments')
+    json_comments = task.result
     if json_comments is None:
       logging.error('Error: Did not manage to obtain the comment section '
                     '(url: %s)', task.url)
@@ -502,6 +653,7 @@ class CommentTaskProcessor(AsyncTaskProcessor):
               comment_parser = LJCommentParser(self.image_downloader, com)
               if jc['article']:
                 comment_parser.feed(jc['article'])
+                comment_parser.finish()
               task.comments.append(com)
               self.comment_ids[com[ENUM_COM.THREAD]] = task
             else:
@@ -594,59 +746,6 @@ class CommentTaskProcessor(AsyncTaskProcessor):
                  task.url, len(task.comments), len(task.children))
 
 
-def get_webpage_content(addr, max_attempts=3, backoff_factor=1.0):
-  err = out = None
-  headers = {"Cookie": "adult_explicit=1"}
-  request = urllib.request.Request(addr, headers=headers)
-
-  for attempt in range(1, max_attempts + 1):
-    try:
-      response = urllib.request.urlopen(request)
-      out = response.read().decode("UTF-8")
-      length = response.info()["Content-Length"]
-      if length is None:
-          length = "unknown size"
-      logging.info("Downloading content of '%s'... [%s]", addr, length)
-
-      # Clear any errors from previous failed attempts upon success
-      err = None
-      break  # Exit the retry loop on success
-    except urllib.error.URLError as e:
-      err = e.reason
-
-      if attempt < max_attempts:
-        # Exponential backoff delay (e.g., 1s, 2s, 4s...)
-        sleep_time = backoff_factor * (2 ** (attempt - 1))
-        logging.warning(
-            "Attempt %d/%d failed: %s. Retrying in %.1f seconds...",
-            attempt,
-            max_attempts,
-            err,
-            sleep_time,
-        )
-        time.sleep(sleep_time)
-      else:
-        # Log the final failure once all attempts are exhausted
-        logging.error(
-           "Error: Downloading content of web page '%s' failed after %d attempts (%s)",
-           addr,
-           max_attempts,
-           err,
-        )
-  return out, err
-
-
-def extract_json_contents(page_content):
-  contents = {}
-  for section_name in ('page', 'entry'):
-    m = re.search(('^.*Site.%s = (.+);' % (section_name)), page_content, re.MULTILINE)
-    if m is None:
-      logging.error("Warning: Parsing the page: no json content of section '%s'" % (section_name))
-      continue
-    contents[section_name] = json.loads(m.group(1))
-  return contents
-
-
 def extract_author(json_contents, post):
   entry_json = json_contents.get('entry')
   if entry_json:
@@ -681,79 +780,221 @@ def save_json_to_file(js, filename):
     json.dump(js, out, ensure_ascii=False, indent=2)
 
 
-def add_post_to_index(postid, index):
-  if postid in index[ENUM_INDEX.POSTS]:
-    if  OPT_REWRITE_POSTS_EXISTING == ANSW_ASK:
-      if not helpers.confirm(
-          'Post %s is already saved. Do you want to update it?' % postid):
-        return
-    elif OPT_REWRITE_POSTS_EXISTING == ANSW_NO:
-      return
+async def confirm_rewrite(postid):
+  async with confirm_lock:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        None, helpers.confirm,
+        'Post %s is already saved. Do you want to update it?' % postid)
 
-  page_content, err = get_webpage_content(page_addr)
-  if err: exit(2)
 
+async def download_post_contents(page_addr, page_content, postid, index,
+                                 client, image_store, userpic_store,
+                                 checkpoint):
   post = {
       ENUM_POST.ID:       postid,
       ENUM_POST.HEADER:   '',
-      ENUM_POST.MAIN_DIR: index[ENUM_INDEX.LJUSER],
+      ENUM_POST.MAIN_DIR: index.ljuser,
       ENUM_POST.FILES:    {},
       ENUM_POST.TAGS:     {},
       ENUM_POST.COMMENTS: [],
   }
 
   image_downloader = ImageDownloader(main_dir=post[ENUM_POST.MAIN_DIR],
-                                     sub_dir=postid)
-  userpic_downloader = UserpicDownloader(main_dir=post[ENUM_POST.MAIN_DIR])
-  post_parser = LJPostParser(image_downloader, post)
-  logging.info('Parsing the post...')
-  post_parser.feed(page_content)
-  post[ENUM_POST.LINK] = page_addr
-  json_contents = extract_json_contents(page_content)
-  if not (extract_author(json_contents, post) and
-          extract_header(json_contents, post)):
-    return
+                                     store=image_store, checkpoint=checkpoint,
+                                     client=client)
+  userpic_downloader = UserpicDownloader(main_dir=post[ENUM_POST.MAIN_DIR],
+                                         store=userpic_store, client=client)
+  # the text of the post plans its images as soon as it is parsed, so the
+  #   downloads are cancelled if the post is abandoned or fails
+  try:
+    post_parser = LJPostParser(image_downloader, post)
+    logging.info('Parsing the post %s...', postid)
+    post_parser.feed(page_content)
+    post_parser.finish()
+    post[ENUM_POST.LINK] = page_addr
+    json_contents = extract_json_contents(page_content)
+    if not (extract_author(json_contents, post) and
+            extract_header(json_contents, post)):
+      return None
+
+    if post.get(ENUM_POST.COMPAGES) is None:
+      post[ENUM_POST.COMPAGES] = []
+      post[ENUM_POST.COMPAGES].append('/%s.html' % postid)
+
+    logging.info('Parsing the comments of post %s (%d page(s) found)...',
+        postid, len(post[ENUM_POST.COMPAGES]))
+    comment_processor = CommentTaskProcessor(
+        image_downloader, userpic_downloader, checkpoint, client=client)
+    comment_page_urls = []
+    for comment_page_link in post[ENUM_POST.COMPAGES]:
+      comment_page_url = 'https://%s.livejournal.com%s' % (index.ljuser, comment_page_link)
+      comment_page_url = enrich_url_with_noscroll(comment_page_url)
+      comment_page_urls.append(comment_page_url)
+      comment_processor.add_task(None, comment_page_url)
+
+    # without a pager the only comment page is the page of the post itself
+    page_comments = json_contents.get('page', {}).get('comments')
+    if (len(comment_page_urls) == 1 and page_comments is not None and
+        comment_page_urls[0] == page_addr):
+      comment_processor.add_page(comment_page_urls[0], page_comments)
+
+    # images and userpics are being downloaded since they were found,
+    #   here we just wait for the rest of them
+    await comment_processor.run()
+    if comment_processor.requeued:
+      logging.warning("Warning: %d comment page(s) of post %s were planned "
+                      "again after failures", comment_processor.requeued,
+                      postid)
+    post[ENUM_POST.COMMENTS] = comment_processor.get_results()
+    await image_downloader.download_files()
+    await userpic_downloader.download_files()
+
+    # import pdb; pdb.set_trace()
+
+    post[ENUM_POST.TEXT] = image_downloader.decode_filenames_in_text(
+        post[ENUM_POST.TEXT])
+    for com in post[ENUM_POST.COMMENTS]:
+      com[ENUM_COM.TEXT] = image_downloader.decode_filenames_in_text(
+          com[ENUM_COM.TEXT])
+      com[ENUM_COM.USERPIC] = userpic_downloader.decode_filenames_in_text(
+          com[ENUM_COM.USERPIC])
+
+    post[ENUM_POST.FILES] = image_downloader.get_files()
+    post[ENUM_POST.FILES].update(userpic_downloader.get_files())
+    return post
+  finally:
+    await image_downloader.cancel_downloads()
+    await userpic_downloader.cancel_downloads()
+
+
+def get_conditional_headers(index_post):
+  headers = {}
+  if index_post.get(ENUM_INDEX.POST_ETAG):
+    headers['If-None-Match'] = index_post[ENUM_INDEX.POST_ETAG]
+  if index_post.get(ENUM_INDEX.POST_LAST_MODIFIED):
+    headers['If-Modified-Since'] = index_post[ENUM_INDEX.POST_LAST_MODIFIED]
+  return headers
+
+
+def set_validators(index_post, response_headers):
+  # a response '304 Not Modified' may leave out some of the validators
+  etag = response_headers.get('etag')
+  if etag is not None:
+    index_post[ENUM_INDEX.POST_ETAG] = etag
+  last_modified = response_headers.get('last-modified')
+  if last_modified is not None:
+    index_post[ENUM_INDEX.POST_LAST_MODIFIED] = last_modified
+
+
+def get_saved_comment_count(main_dir, index_post):
+  """
+  Returns the number of comments saved with a post, which is less than the
+  number of comments of the post if some threads failed to download.
+  """
+  comment_count = index_post.get(ENUM_INDEX.POST_COMMENT_COUNT)
+  if comment_count is not None:
+    return comment_count
+
+  # the post was saved before the index kept the number of saved comments
+  fdata = '%s/%s.data' % (main_dir, index_post[ENUM_INDEX.POST_ID])
+  if not os.path.isfile(fdata):
+    return None
+  with open(fdata, 'r', encoding='utf-8') as f:
+    return len(json.load(f).get(ENUM_POST.COMMENTS) or [])
+
+
+def is_post_unchanged(page_content, index_post, main_dir):
+  replycount = extract_json_contents(page_content, ('page',)).get(
+      'page', {}).get('replycount')
+  comment_count = get_saved_comment_count(main_dir, index_post)
+  if replycount is None or replycount != comment_count:
+    logging.info('Post %s has changed (%s comments, %s saved)',
+                 index_post[ENUM_INDEX.POST_ID], replycount, comment_count)
+    return False
+
+  index_post[ENUM_INDEX.POST_REPLYCOUNT] = replycount
+  index_post[ENUM_INDEX.POST_COMMENT_COUNT] = comment_count
+  return True
+
 
-  if post.get(ENUM_POST.COMPAGES) is None:
-    post[ENUM_POST.COMPAGES] = []
-    post[ENUM_POST.COMPAGES].append('/%s.html' % postid)
-
-  logging.info('Parsing the comments (%d page(s) found)...',
-      len(post[ENUM_POST.COMPAGES]))
-  comment_processor = CommentTaskProcessor(
-      image_downloader, userpic_downloader)
-  for comment_page_link in post[ENUM_POST.COMPAGES]:
-    comment_page_url = 'https://%s.livejournal.com%s' % (index[ENUM_INDEX.LJUSER], comment_page_link)
-    comment_page_url = enrich_url_with_noscroll(comment_page_url)
-    comment_processor.add_task(None, comment_page_url)
-
-  comment_processor.run()
-  post[ENUM_POST.COMMENTS] = comment_processor.get_results()
-  image_downloader.download_files()
-  userpic_downloader.download_files()
-
-  # import pdb; pdb.set_trace()
-
-  post[ENUM_POST.TEXT] = image_downloader.decode_filenames_in_text(
-      post[ENUM_POST.TEXT])
-  for com in post[ENUM_POST.COMMENTS]:
-    com[ENUM_COM.TEXT] = image_downloader.decode_filenames_in_text(
-        com[ENUM_COM.TEXT])
-    com[ENUM_COM.USERPIC] = userpic_downloader.decode_filenames_in_text(
-        com[ENUM_COM.USERPIC])
-
-  # pop redundant fields
-  post.pop(ENUM_POST.FILES)
-
-  outfilename = '%s/%s.data' % (index[ENUM_INDEX.LJUSER], postid)
+async def add_post_to_index(page_addr, postid, index, client, image_store,
+                            userpic_store, db=None, post_semaphore=None):
+  """
+  Downloads a post unless it is skipped and adds it to the index. The page
+  of the post is fetched right away, the rest (comments, images, userpics)
+  waits for `post_semaphore`, so pages of the next posts are fetched while
+  the previous posts are still being downloaded.
+  """
+  index_post = index.get_post(postid)
+  update = False
+  if index_post is not None:
+    if  OPT_REWRITE_POSTS_EXISTING == ANSW_ASK:
+      if not await confirm_rewrite(postid):
+        return True
+    elif OPT_REWRITE_POSTS_EXISTING == ANSW_NO:
+      logging.info('Post %s is already saved, skipping it', postid)
+      return True
+    elif OPT_REWRITE_POSTS_EXISTING == ANSW_UPDATE:
+      update = True
+
+  response_headers = {}
+  page_content, err = await client.get_webpage_content(
+      page_addr,
+      headers=(get_conditional_headers(index_post) if update else None),
+      response_headers=response_headers)
+  if err:
+    return False
+
+  if update:
+    if (page_content is None or
+        is_post_unchanged(page_content, index_post, index.ljuser)):
+      logging.info('Post %s has not changed, skipping it', postid)
+      set_validators(index_post, response_headers)
+      index.add_post(index_post)
+      return True
+
+  if post_semaphore is None:
+    return await save_post(page_addr, page_content, response_headers, postid,
+                           index, client, image_store, userpic_store, db)
+  async with post_semaphore:
+    return await save_post(page_addr, page_content, response_headers, postid,
+                           index, client, image_store, userpic_store, db)
+
+
+async def save_post(page_addr, page_content, response_headers, postid, index,
+                    client, image_store, userpic_store, db=None):
+  """
+  Downloads the comments, images and userpics of a post whose page has been
+  fetched and saves the post.
+  """
+  # what has been done by an interrupted run is taken from the checkpoint
+  checkpoint = PostCheckpoint(index.ljuser, postid)
+  image_store.add_files(checkpoint.files)
+  try:
+    post = await download_post_contents(
+        page_addr, page_content, postid, index, client, image_store,
+        userpic_store, checkpoint)
+  finally:
+    checkpoint.close()
+  if post is None:
+    return False
+
+  # the files are kept in the database only
+  files = post.pop(ENUM_POST.FILES)
+  outfilename = '%s/%s.data' % (index.ljuser, postid)
   save_json_to_file(post, outfilename)
+  if db is not None:
+    db.add_post(post, files)
+  checkpoint.remove()
 
   if (post[ENUM_POST.REPLYCOUNT] is not None and
       len(post[ENUM_POST.COMMENTS]) != post[ENUM_POST.REPLYCOUNT]):
     logging.warning(
         'WARNING: The number of obtained comments (%d) is different than '
-        'in the post (%d)!' % (
-            len(post[ENUM_POST.COMMENTS]), post[ENUM_POST.REPLYCOUNT]))
+        'in the post %s (%d)!' % (
+            len(post[ENUM_POST.COMMENTS]), postid,
+            post[ENUM_POST.REPLYCOUNT]))
 
   logging.info("Summary: %d comments have been saved to file '%s'",
       len(post[ENUM_POST.COMMENTS]), outfilename)
@@ -763,11 +1004,12 @@ def add_post_to_index(postid, index):
       ENUM_INDEX.POST_HEADER: post[ENUM_POST.HEADER],
       ENUM_INDEX.POST_DATE:   post[ENUM_POST.DATE],
       ENUM_INDEX.POST_TAGS:   post[ENUM_POST.TAGS],
+      ENUM_INDEX.POST_REPLYCOUNT: post[ENUM_POST.REPLYCOUNT],
+      ENUM_INDEX.POST_COMMENT_COUNT: len(post[ENUM_POST.COMMENTS]),
   }
-  index[ENUM_INDEX.POSTS][postid] = index_post
-
-  outfilename = '%s/index.data' % (index[ENUM_INDEX.LJUSER])
-  save_json_to_file(index, outfilename)
+  set_validators(index_post, response_headers)
+  index.add_post(index_post)
+  return True
 
 
 def enrich_url_with_noscroll(url):
@@ -788,42 +1030,179 @@ def add_argument_to_url(url, arg_key, arg_val):
   return urllib.parse.urlunsplit(new_url_split)
 
 
-# MAIN
-if __name__=='__main__':
-  if len(sys.argv) < 2:
-    print('Error: Too few params')
-    exit(1)
+def parse_post_link(line):
+  """
+  Accepts either a bare post link or a line in the `<date> <link>` format
+  produced by lj-get-post-links-for-year.py and returns the link.
+  """
+  line = line.strip()
+  if not line or line.startswith('#'):
+    return None
+  return line.split()[-1]
 
-  logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
 
-  page_addr = sys.argv[1]
+async def iter_post_links(links, input_file):
+  for link in links:
+    yield link
 
-  m = re.search('(?:/*)([\w\-]+)\.livejournal.com/(\d+)\.\w*', page_addr)
-  if m is None:
-    logging.crtical("Error: Parsing '%s' failed", page_addr)
-    exit(2)
+  if input_file is None:
+    return
 
-  ljuser = m.group(1)
-  postid = m.group(2)
-  logging.info("ljuser: '%s', postid: '%s'", ljuser, postid)
+  if input_file == '-':
+    # read stdin lazily, so posts start downloading while links still arrive
+    loop = asyncio.get_running_loop()
+    while True:
+      line = await loop.run_in_executor(None, sys.stdin.readline)
+      if not line:
+        break
+      link = parse_post_link(line)
+      if link:
+        yield link
+  else:
+    with open(input_file, 'r', encoding='utf-8') as f:
+      for line in f:
+        link = parse_post_link(line)
+        if link:
+          yield link
 
+
+def load_index(ljuser):
   main_dir = './%s' % ljuser
   if not os.path.exists(main_dir):
     os.makedirs(main_dir)
+  return PostIndex(ljuser).load()
+
+
+def save_index(index):
+  index.set_date(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+  index.close()
+
+
+def sync_post_to_db(db, main_dir, postid):
+  """
+  Imports a post which has been saved before the database was used.
+  """
+  fdata = '%s/%s.data' % (main_dir, postid)
+  if not db.has_post(postid) and os.path.isfile(fdata):
+    logging.info("Importing '%s' into the database", fdata)
+    db.add_post_file(fdata)
+
+
+async def download_posts(links, input_file, max_posts, userpic_store_dir,
+                         use_db=False):
+  indexes = {}
+  image_stores = {}
+  databases = {}
+  seen = set()   # (ljuser, postid) of the posts listed so far
+  failed = []
+  # up to `max_posts` posts are downloaded and as many pages of the next
+  #   posts are fetched ahead
+  semaphore = asyncio.Semaphore(2 * max_posts)
+  post_semaphore = asyncio.Semaphore(max_posts)
+  userpic_store = UserpicStore(userpic_store_dir)
+
+  async def download_post(page_addr, postid, index, client):
+    try:
+      db = databases.get(index.ljuser)
+      if not await add_post_to_index(
+          page_addr=page_addr, postid=postid, index=index, client=client,
+          image_store=image_stores[index.ljuser],
+          userpic_store=userpic_store, db=db, post_semaphore=post_semaphore):
+        failed.append(page_addr)
+      elif db is not None:
+        sync_post_to_db(db, index.ljuser, postid)
+    except Exception:
+      logging.exception("Error: Downloading the post '%s' failed", page_addr)
+      failed.append(page_addr)
+    finally:
+      semaphore.release()
+
+  async with HttpClient() as client:
+    tasks = []
+    try:
+      async for page_addr in iter_post_links(links, input_file):
+        m = re.search('(?:/*)([\w\-]+)\.livejournal.com/(\d+)\.\w*', page_addr)
+        if m is None:
+          logging.error("Error: Parsing '%s' failed", page_addr)
+          failed.append(page_addr)
+          continue
+
+        ljuser = m.group(1)
+        postid = m.group(2)
+        if (ljuser, postid) in seen:
+          logging.info("Post %s of '%s' is listed again, skipping it",
+                       postid, ljuser)
+          continue
+        seen.add((ljuser, postid))
+        logging.info("ljuser: '%s', postid: '%s'", ljuser, postid)
+
+        if ljuser not in indexes:
+          indexes[ljuser] = load_index(ljuser)
+          image_stores[ljuser] = ImageStore(ljuser)
+          if use_db:
+            databases[ljuser] = PostDatabase(ljuser)
+
+        await semaphore.acquire()
+        tasks.append(asyncio.ensure_future(download_post(
+            enrich_url_with_noscroll(page_addr), postid, indexes[ljuser],
+            client)))
+
+      if tasks:
+        await asyncio.wait(tasks)
+    finally:
+      for index in indexes.values():
+        save_index(index)
+      for image_store in image_stores.values():
+        image_store.save()
+      for db in databases.values():
+        db.close()
+
+  if failed:
+    logging.error('Error: %d post(s) failed: %s', len(failed), ' '.join(failed))
+  return failed
 
-  index = None
-  findex = '%s/index.data' % main_dir
-  if not os.path.isfile(findex):
-    index = {}
-    index[ENUM_INDEX.POSTS] = {}
-    index[ENUM_INDEX.LJUSER] = ljuser
-  else:
-    with open(findex, 'r', encoding='utf-8') as f:
-      index = json.load(f)
-      logging.info("Found index file '%s' (%d posts)",
-          findex, len(index[ENUM_INDEX.POSTS]))
 
-  index[ENUM_INDEX.DATE] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+# MAIN
+if __name__=='__main__':
+  parser = argparse.ArgumentParser(
+      description='Downloads livejournal posts with comments, images and '
+                  'userpics.')
+  parser.add_argument('links', nargs='*',
+      help='links to the posts to download')
+  parser.add_argument('-i', '--input', dest='input_file',
+      help="file with post links, one per line, either '<link>' or "
+           "'<date> <link>' ('-' reads stdin)")
+  parser.add_argument('-j', '--jobs', type=int, default=2,
+      help='number of posts downloaded concurrently (default: %(default)s)')
+  parser.add_argument('--rewrite-existing',
+      choices=('ask', 'yes', 'no', 'update'), default='ask',
+      help="what to do with posts which are already saved, 'update' "
+           "downloads them again only if they have changed "
+           "(default: %(default)s)")
+  parser.add_argument('--userpic-store', default=UserpicStore.STORE_DIR_DEFAULT,
+      help='directory with userpics shared by all the journals '
+           '(default: %(default)s)')
+  parser.add_argument('--db', action='store_true',
+      help="also save the posts to the database '<ljuser>/%s'" %
+           PostDatabase.FILENAME)
+  args = parser.parse_args()
+
+  if not args.links and args.input_file is None:
+    print('Error: Too few params')
+    exit(1)
+
+  logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
 
-  page_addr = enrich_url_with_noscroll(page_addr)
-  add_post_to_index(index=index, postid=postid)
+  OPT_REWRITE_POSTS_EXISTING = {
+      'ask': ANSW_ASK, 'yes': ANSW_YES, 'no': ANSW_NO, 'update': ANSW_UPDATE,
+  }[args.rewrite_existing]
+  if OPT_REWRITE_POSTS_EXISTING == ANSW_ASK and args.input_file == '-':
+    # stdin is busy with the links, so nobody can answer the question
+    logging.warning("Links are read from stdin, existing posts will be skipped")
+    OPT_REWRITE_POSTS_EXISTING = ANSW_NO
+
+  failed = asyncio.run(download_posts(
+      args.links, args.input_file, max(1, args.jobs), args.userpic_store,
+      args.db))
+  if failed:
+    exit(2)
@@ -4,12 +4,15 @@
 This script accepts 2 arguments:
   - page_addr - a link to some post page of the livejournal which is supposed
                 to be downloaded.
-  - year - a year for which all post links will be fetched.
+  - year - a year (e.g. 2015) or a range of years (e.g. 2010-2015) for which
+           all post links will be fetched. If it is omitted, the years are
+           taken from the year links of the calendar, i.e. the whole journal
+           is fetched.
 
-It downloads a calendar page of a given year, looks for a proper year calendar
-parser, then downloads all calendar pages of days with posts published
-(one by one), looks for a proper day calendar parser, then obtains all post
-links and prints them to STDOUT in the following format:
+It downloads the calendar pages of the given years, looks for a proper year
+calendar parser, then downloads all calendar pages of days with posts
+published (several at a time), looks for a proper day calendar parser, then
+obtains all post links and prints them to STDOUT in the following format:
 
 <post_date1> <post_link1>
 <post_date1> <post_link2>
@@ -17,6 +20,11 @@ links and prints them to STDOUT in the following format:
 <post_date3> <post_link4>
 ...
 
+The links are printed as soon as the pages of their day and of all the
+previous days are fetched (or as soon as the page of their day is fetched
+with '--unordered'), so the output can be piped to `lj-dl.py -i -` which
+starts downloading the posts while the calendar is still being fetched.
+
 Debug logging is printed to STDERR, so can be easily filtered.
 
 For now the script supports only Minimalism style, so if you need other styles,
@@ -24,12 +32,22 @@ you can extend this script with new parsers and add their support to the functio
 `get_year_calendar_parser` and `and get_day_calendar_parser`.
 """
 
+import argparse
+import asyncio
+import datetime
+import logging
 import sys
-import time
-import urllib.request
 import re
 from html.parser import HTMLParser
 
+from download_helpers import HttpClient
+
+
+# number of calendar pages downloaded at the same time
+MAX_CONNECTIONS_DEFAULT = 8
+# livejournal was started in 1999
+MIN_YEAR = 1999
+
 
 """
 Common functions
@@ -65,48 +83,14 @@ def retrieve_date_from_post_day_link(link):
   return dt
 
 
-def get_webpage_content(addr, max_attempts=3, backoff_factor=1.0):
-  err = out = None
-  headers = {"Cookie": "adult_explicit=1"}
-  request = urllib.request.Request(addr, headers=headers)
-
-  for attempt in range(1, max_attempts + 1):
-    try:
-      response = urllib.request.urlopen(request)
-      out = response.read().decode("UTF-8")
-      length = response.info()["Content-Length"]
-      if length is None:
-          length = "unknown size"
-      vprint("Downloading content of '%s'... [%s]" % (addr, length))
-
-      # Clear any errors from previous failed attempts upon success
-      err = None
-      break  # Exit the retry loop on success
-    except urllib.error.URLError as e:
-      err = e.reason
-
-      if attempt < max_attempts:
-        # Exponential backoff delay (e.g., 1s, 2s, 4s...)
-        sleep_time = backoff_factor * (2 ** (attempt - 1))
-        vprint(
-            "Attempt %d/%d failed: %s. Retrying in %.1f seconds..." % (
-                attempt,
-                max_attempts,
-                err,
-                sleep_time
-            )
-        )
-        time.sleep(sleep_time)
-      else:
-        # Log the final failure once all attempts are exhausted
-        vprint(
-           "Error: Downloading content of web page '%s' failed after %d attempts (%s)" % (
-               addr,
-               max_attempts,
-               err,
-           )
-        )
-  return out, err
+def retrieve_years_from_year_page(ljuser, page_content):
+  """
+  Returns the years linked from a page of the year calendar, i.e. the years
+  with posts published.
+  """
+  years = re.findall(r"%s\.livejournal\.com/(\d{4})/[\"']" % re.escape(ljuser),
+                     page_content)
+  return sorted(set(int(year) for year in years))
 
 
 class YearCalendarMinimalismParser(HTMLParser):
@@ -132,7 +116,7 @@ class YearCalendarMinimalismParser(HTMLParser):
         for (k, v) in attrs:
           if k == "href":
             if is_post_day_link(v):
-              day_links.append(v)
+              self.day_links.append(v)
 
   def handle_endtag(self, tag):
     if tag == "div":
@@ -187,72 +171,183 @@ def get_day_calendar_parser(page_content):
   return None
 
 
-def scan_year_calendar(ljuser, year, day_links):
+async def scan_year_calendar(client, ljuser, year, day_links, years=None):
   """
-  Scans a page of the calendar for a given year and saves links to day pages
-  which contains posts.
+  Scans a page of the calendar for a given year, saves links to day pages
+  which contains posts and returns the exit code. The years linked from the
+  page are saved to `years` if it is given.
   """
   if not ljuser or not year:
     raise ValueError
 
   page_addr = ("https://%s.livejournal.com/%d/" % (ljuser, year))
-  (page_content, err) = get_webpage_content(page_addr)
-  if err: exit(2)
+  (page_content, err) = await client.get_webpage_content(page_addr)
+  if err: return 2
 
   parser_class = get_year_calendar_parser(page_content)
   if not parser_class:
     eprint("Error: No Year Calendar parser found!")
-    exit(3)
+    return 3
 
   page_parser = parser_class(day_links)
   vprint("Parsing the page '%s'..." % page_addr)
   page_parser.feed(page_content)
+  if years is not None:
+    years.extend(retrieve_years_from_year_page(ljuser, page_content))
+  return 0
 
 
-def scan_day_calendar(day_links, post_links):
+async def scan_day_page(client, semaphore, day_link):
   """
-  Scans a page of the calendar for a given day and saves links to post pages
-  which were published on that day.
+  Scans a page of the calendar for a given day and returns the exit code and
+  links to post pages which were published on that day.
   """
-  for day_link in day_links:
-      (page_content, err) = get_webpage_content(day_link)
-      if err: exit(2)
+  async with semaphore:
+    (page_content, err) = await client.get_webpage_content(day_link)
+  if err: return 2, None
 
-      parser_class = get_day_calendar_parser(page_content)
-      if not parser_class:
-        eprint("Error: No Day Calendar parser found!")
-        exit(3)
+  parser_class = get_day_calendar_parser(page_content)
+  if not parser_class:
+    eprint("Error: No Day Calendar parser found!")
+    return 3, None
 
-      parser = parser_class(post_links)
-      parser.set_post_date(retrieve_date_from_post_day_link(day_link))
-      parser.feed(page_content)
+  post_links = []
+  parser = parser_class(post_links)
+  parser.set_post_date(retrieve_date_from_post_day_link(day_link))
+  parser.feed(page_content)
+  return 0, post_links
 
 
-if __name__ == '__main__':
-  if len(sys.argv) < 3:
-    print("Error: Too few params")
-    exit(1)
+async def scan_calendar(client, ljuser, years, emit_link, ordered=True,
+                        max_connections=MAX_CONNECTIONS_DEFAULT):
+  """
+  Scans the calendar of the given years (several pages at a time: the year
+  pages at once, the day pages as soon as their year page is parsed) and
+  calls `emit_link(post_date, post_link)` for every post as soon as it is
+  found. If `ordered`, the links are emitted in the order of the days, i.e.
+  the links of a day are held until all the previous days are scanned.
+  Returns the exit code.
+  """
+  semaphore = asyncio.Semaphore(max_connections)
+  tasks = []
+
+  async def scan_day(day_link):
+    (code, post_links) = await scan_day_page(client, semaphore, day_link)
+    if not code and not ordered:
+      for post_link in post_links:
+        emit_link(*post_link)
+    return code, post_links
+
+  async def scan_year(year):
+    day_links = []
+    async with semaphore:
+      code = await scan_year_calendar(client, ljuser, year, day_links)
+    if code: return code, None
+    day_tasks = [asyncio.ensure_future(scan_day(day_link))
+                 for day_link in day_links]
+    tasks.extend(day_tasks)
+    return 0, day_tasks
+
+  year_tasks = [asyncio.ensure_future(scan_year(year)) for year in years]
+  tasks.extend(year_tasks)
+  try:
+    for year_task in year_tasks:
+      (code, day_tasks) = await year_task
+      if code: return code
+      for day_task in day_tasks:
+        (code, post_links) = await day_task
+        if code: return code
+        if ordered:
+          for post_link in post_links:
+            emit_link(*post_link)
+  finally:
+    # the rest of the pages are not needed after an error
+    for task in tasks:
+      task.cancel()
+  return 0
+
+
+async def scan_journal_calendar(ljuser, years, emit_link, ordered=True,
+                                max_connections=MAX_CONNECTIONS_DEFAULT):
+  """
+  Scans the calendar of the given years with one shared HTTP client, all
+  the years of the journal are scanned if `years` is None. Returns the exit
+  code.
+  """
+  async with HttpClient() as client:
+    if years is None:
+      this_year = datetime.date.today().year
+      years = []
+      code = await scan_year_calendar(client, ljuser, this_year, [], years)
+      if code: return code
+      if not years:
+        years = [this_year]
+      vprint("Years: %s" % ", ".join(str(year) for year in years))
 
-  page_addr = sys.argv[1]
-  year = sys.argv[2]
+    return await scan_calendar(client, ljuser, years, emit_link, ordered,
+                               max_connections)
 
-  m = re.search("(?:/*)([\w\-]+)\.livejournal.com\w*", page_addr)
+
+def parse_years(years):
+  """
+  Returns the list of years for a year (e.g. '2015') or a range of years
+  (e.g. '2010-2015'), or None if the years are invalid.
+  """
+  m = re.fullmatch(r"(\d{4})(?:-(\d{4}))?", years.strip())
   if m is None:
-    eprint("Error: Parsing '%s' failed" % (page_addr))
+    return None
+
+  first = int(m.group(1))
+  last = int(m.group(2) or first)
+  if first > last:
+    return None
+  return list(range(first, last + 1))
+
+
+def emit_post_link(post_date, post_link):
+  print(post_date, post_link, flush=True)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+      description="Prints the links to the posts of a livejournal")
+  parser.add_argument("page_addr",
+                      help="a link to some post page of the livejournal")
+  parser.add_argument("year", nargs="?",
+                      help="a year (e.g. 2015) or a range of years "
+                           "(e.g. 2010-2015), the whole journal by default")
+  parser.add_argument("-j", "--jobs", type=int,
+                      default=MAX_CONNECTIONS_DEFAULT,
+                      help="number of calendar pages downloaded at the same "
+                           "time (default: %(default)s)")
+  parser.add_argument("-u", "--unordered", action="store_true",
+                      help="print the links of a day as soon as its page is "
+                           "fetched, even if the previous days are not yet")
+  args = parser.parse_args()
+
+  m = re.search("(?:/*)([\w\-]+)\.livejournal.com\w*", args.page_addr)
+  if m is None:
+    eprint("Error: Parsing '%s' failed" % (args.page_addr))
     exit(2)
 
+  logging.basicConfig(level=(logging.INFO if verbose else logging.WARNING),
+                      format='%(message)s')
+
   ljuser = m.group(1)
   vprint("ljuser: '%s'" % ljuser)
 
-  year = int(year)
-  if year < 2000 or year > 2030:
-    eprint("Error: The year %d seems to be in invalid range (allowed range is 2000 < year < 2030)" % (year))
-    exit(3)
+  years = None
+  if args.year is not None:
+    years = parse_years(args.year)
+    max_year = datetime.date.today().year
+    if not years or years[0] < MIN_YEAR or years[-1] > max_year:
+      eprint("Error: The year '%s' seems to be in invalid range (allowed range is %d <= year <= %d)" % (args.year, MIN_YEAR, max_year))
+      exit(3)
 
-  day_links = []
-  scan_year_calendar(ljuser, year, day_links)
+  if args.jobs < 1:
+    eprint("Error: The number of jobs must be positive")
+    exit(1)
 
-  post_links = []
-  scan_day_calendar(day_links, post_links)
-  for post_link in post_links:
-    print(post_link[0], post_link[1])
+  code = asyncio.run(scan_journal_calendar(
+      ljuser, years, emit_post_link, not args.unordered, args.jobs))
+  if code: exit(code)
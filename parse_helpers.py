@@ -0,0 +1,257 @@
+"""
+"""
+
+import codecs
+import json
+import logging
+import re
+
+
+SITE_SECTIONS_DEFAULT = ('page', 'entry')
+SITE_SECTION_PATTERN = re.compile(r'Site\.(\w+) = ')
+
+_json_decoder = json.JSONDecoder()
+
+
+def extract_json_contents(page_content, sections=SITE_SECTIONS_DEFAULT):
+  """
+  Extracts the json contents of the given `Site.<section> = {...};`
+  assignments of a page. The page is scanned once from the beginning, only
+  the requested sections are decoded, and the scan stops as soon as all of
+  them are found.
+  """
+  contents = {}
+  pos = 0
+  while len(contents) < len(sections):
+    m = SITE_SECTION_PATTERN.search(page_content, pos)
+    if m is None:
+      break
+
+    pos = m.end()
+    section_name = m.group(1)
+    if section_name not in sections or section_name in contents:
+      continue
+
+    try:
+      contents[section_name], pos = _json_decoder.raw_decode(page_content, pos)
+    except ValueError as e:
+      logging.error("Warning: Parsing the page: invalid json content of "
+                    "section '%s' (%s)", section_name, e)
+
+  for section_name in sections:
+    if section_name not in contents:
+      logging.error("Warning: Parsing the page: no json content of section "
+                    "'%s'" % (section_name))
+  return contents
+
+
+class SiteSectionScanner():
+  """
+  Incremental version of `extract_json_contents` for a page which is being
+  downloaded. Chunks of the page are fed as they arrive and the scanner
+  tells when all the requested sections have been captured, so the rest of
+  the page does not have to be downloaded. Only the text of the section
+  which is being captured is kept in memory.
+  """
+
+  # long enough to hold a 'Site.<section> = ' marker split between chunks
+  TAIL_SIZE = 64
+  # a value which is not complete by this size is given up
+  VALUE_SIZE_MAX = 1 << 25
+
+  def __init__(self, sections=SITE_SECTIONS_DEFAULT):
+    self.sections = sections
+    self.contents = {}
+    self.decoder = codecs.getincrementaldecoder('utf-8')()
+    self.tail = ''
+    self.section = None
+    self.value_parts = None  # text of the section value read so far
+    self.done = False
+
+  def feed(self, data):
+    """
+    Feeds the next chunk (bytes) of the page. Returns True when all the
+    sections have been captured.
+    """
+    text = self.decoder.decode(data)
+    while text and not self.done:
+      if self.value_parts is None:
+        text = self._find_section(text)
+      else:
+        text = self._read_value(text)
+    return self.done
+
+  def _find_section(self, text):
+    text = self.tail + text
+    m = SITE_SECTION_PATTERN.search(text)
+    while m is not None and (m.group(1) not in self.sections or
+                             m.group(1) in self.contents):
+      m = SITE_SECTION_PATTERN.search(text, m.end())
+
+    if m is None:
+      self.tail = text[-self.TAIL_SIZE:]
+      return ''
+
+    self.tail = ''
+    self.section = m.group(1)
+    self.value_parts = []
+    return text[m.end():]
+
+  def _read_value(self, text):
+    # the json value is on one line, so it is decoded once the line ends
+    pos = text.find('\n')
+    if pos < 0:
+      self.value_parts.append(text)
+      return ''
+
+    self.value_parts.append(text[:pos + 1])
+    value_text = ''.join(self.value_parts)
+    try:
+      value, end = _json_decoder.raw_decode(value_text)
+    except json.JSONDecodeError as e:
+      if (e.pos >= len(value_text.rstrip()) and
+          len(value_text) <= self.VALUE_SIZE_MAX):
+        # the value goes on in the next line
+        return text[pos + 1:]
+
+      # the value is invalid, the section is looked for further on like
+      #   extract_json_contents does
+      logging.error("Warning: Parsing the page: invalid json content of "
+                    "section '%s' (%s)", self.section, e)
+      self.value_parts = None
+      return value_text + text[pos + 1:]
+
+    self.contents[self.section] = value
+    self.value_parts = None
+    self.done = len(self.contents) == len(self.sections)
+    return value_text[end:] + text[pos + 1:]
+
+  def close(self):
+    """
+    Returns the captured sections once the page is over (or abandoned).
+    """
+    if self.value_parts is not None and not self.done:
+      # the page ended in the middle of a value, it may lack the newline
+      try:
+        value, end = _json_decoder.raw_decode(''.join(self.value_parts))
+        self.contents[self.section] = value
+      except ValueError as e:
+        logging.error("Warning: Parsing the page: invalid json content of "
+                      "section '%s' (%s)", self.section, e)
+      self.value_parts = None
+
+    for section_name in self.sections:
+      if section_name not in self.contents:
+        logging.error("Warning: Parsing the page: no json content of section "
+                      "'%s'" % (section_name))
+    return self.contents
+
+
+class JsonFileReader():
+  """
+  Reads json values from a file by chunks, so a file does not have to be
+  in memory at once. A chunk is at least as big as the data left in the
+  buffer, so a value spanning many chunks is decoded in linear time.
+  """
+
+  CHUNK_SIZE = 1 << 16
+  WHITESPACE = re.compile(r'[ \t\n\r]*')
+  LIST_SEPARATOR = re.compile(r'[ \t\n\r]*([,\]])[ \t\n\r]*')
+  NUMBER_TAIL = re.compile(r'[0-9+\-.eE]*')
+
+  def __init__(self, f, chunk_size=None):
+    self.f = f
+    self.chunk_size = chunk_size or self.CHUNK_SIZE
+    self.buf = ''
+    self.pos = 0
+    self.eof = False
+
+  def _fill(self):
+    if self.eof:
+      return False
+    data = self.f.read(max(self.chunk_size, len(self.buf) - self.pos))
+    if not data:
+      self.eof = True
+      return False
+    self.buf = self.buf[self.pos:] + data
+    self.pos = 0
+    return True
+
+  def peek(self):
+    while True:
+      self.pos = self.WHITESPACE.match(self.buf, self.pos).end()
+      if self.pos < len(self.buf) or not self._fill():
+        return self.buf[self.pos:self.pos + 1]
+
+  def expect(self, chars):
+    c = self.peek()
+    if not c or c not in chars:
+      raise ValueError("Unexpected %r at the position %d, expected %r" % (
+          c, self.pos, chars))
+    self.pos += 1
+    return c
+
+  def decode(self):
+    self.peek()
+    while True:
+      try:
+        value, end = _json_decoder.scan_once(self.buf, self.pos)
+        # a number which reaches the end of the buffer may go on in the next
+        #   chunk, also when it is cut after its '.' or 'e' which are not
+        #   decoded as a part of it then
+        if (not isinstance(value, (int, float)) or
+            self.NUMBER_TAIL.match(self.buf, end).end() < len(self.buf) or
+            not self._fill()):
+          self.pos = end
+          return value
+      except (StopIteration, ValueError):
+        if not self._fill():
+          # decode it once more for the error message
+          _json_decoder.raw_decode(self.buf, self.pos)
+          raise
+
+  def iter_list(self):
+    """
+    Iterates over the elements of the list which starts at the current
+    position.
+    """
+    self.expect('[')
+    if self.peek() == ']':
+      self.pos += 1
+      return
+
+    while True:
+      yield self.decode()
+      m = self.LIST_SEPARATOR.match(self.buf, self.pos)
+      if m is not None and m.end() < len(self.buf):
+        # the separator and the next element are in the buffer already
+        self.pos = m.end()
+        if m.group(1) == ']':
+          return
+      elif self.expect(',]') == ']':
+        return
+
+
+def iter_json_object(f, list_key):
+  """
+  Iterates over the items of the json object in a file reading it by chunks.
+  Yields (key, value) for every item except `list_key` whose list is yielded
+  element by element as (list_key, element), so even a huge list is never in
+  memory at once.
+  """
+  reader = JsonFileReader(f)
+  reader.expect('{')
+  if reader.peek() == '}':
+    return
+
+  while True:
+    key = reader.decode()
+    reader.expect(':')
+    if key == list_key and reader.peek() == '[':
+      for value in reader.iter_list():
+        yield key, value
+    else:
+      yield key, reader.decode()
+
+    if reader.expect(',}') == '}':
+      return
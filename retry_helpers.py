@@ -0,0 +1,82 @@
+"""
+"""
+
+import aiohttp
+import asyncio
+import logging
+import random
+
+
+class RetryPolicy():
+  """
+  When and how long a failed request waits before it is tried again, shared
+  by all the requests of an HttpClient. The delay doubles with every attempt
+  and is jittered, so the retries of requests which failed together spread
+  out. All the retries are limited by a budget which refills with successful
+  requests, so a server which is down is not flooded with retries.
+  """
+
+  MAX_ATTEMPTS = 4
+  BACKOFF_BASE = 1.0
+  BACKOFF_MAX = 30.0
+  # the budget allows BUDGET_MIN retries plus one for every 1 / BUDGET_RATIO
+  #   successful requests
+  BUDGET_MIN = 20
+  BUDGET_RATIO = 0.2
+  RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+  def __init__(self, max_attempts=MAX_ATTEMPTS, backoff_base=BACKOFF_BASE):
+    self.max_attempts = max_attempts
+    self.backoff_base = backoff_base
+    self.successes = 0
+    self.retries = 0
+    self.exhausted = 0   # retries refused because of the budget
+
+  def is_retryable(self, status=None, error=None):
+    """
+    Returns whether a response with `status` or a request which failed with
+    `error` is worth another attempt.
+    """
+    if error is not None:
+      if isinstance(error, aiohttp.ClientResponseError):
+        return error.status in self.RETRY_STATUSES
+      return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+    return status in self.RETRY_STATUSES
+
+  def can_retry(self, attempt):
+    if attempt >= self.max_attempts:
+      return False
+    if self.retries >= self.BUDGET_MIN + self.BUDGET_RATIO * self.successes:
+      self.exhausted += 1
+      return False
+    return True
+
+  def get_delay(self, attempt, retry_after=None):
+    delay = min(self.BACKOFF_MAX, self.backoff_base * 2 ** (attempt - 1))
+    delay = delay / 2 + random.uniform(0, delay / 2)
+    if retry_after is not None:
+      delay = max(delay, retry_after)
+    return delay
+
+  def add_success(self):
+    self.successes += 1
+
+  def add_retry(self):
+    self.retries += 1
+
+  async def wait(self, url, attempt, err, retry_after=None):
+    """
+    Waits before the next attempt of a failed request.
+    """
+    self.add_retry()
+    delay = self.get_delay(attempt, retry_after)
+    logging.warning("Warning: Attempt %d/%d of '%s' failed: %s. Retrying in "
+                    "%.1f seconds...", attempt, self.max_attempts, url, err,
+                    delay)
+    await asyncio.sleep(delay)
+
+  def get_stats(self):
+    stats = "%d retries" % self.retries
+    if self.exhausted:
+      stats += " (%d refused by the retry budget)" % self.exhausted
+    return stats
@@ -0,0 +1,273 @@
+"""
+"""
+
+import html
+import json
+import re
+
+
+SEARCH_DIR = 'search'
+SEARCH_CACHE = 'cache.json'
+TERM_PATTERN = re.compile(r'\w+')
+TAG_PATTERN = re.compile(r'<[^>]*>')
+TERM_MIN_LENGTH = 2
+TERM_MAX_LENGTH = 40
+# the number of shards grows with the number of terms in steps of 2, so it
+#   rarely changes
+SHARD_TERMS = 1000
+SHARDS_MAX = 4096
+
+
+def get_terms(text):
+  """
+  Returns the search terms of a text (html tags are dropped).
+  """
+  if not text:
+    return []
+  text = html.unescape(TAG_PATTERN.sub(' ', text)).lower()
+  return [term for term in TERM_PATTERN.findall(text)
+          if TERM_MIN_LENGTH <= len(term) <= TERM_MAX_LENGTH]
+
+
+def count_post_terms(header, tags, text, comments):
+  """
+  Returns the terms of a post { term: [post hits, comment hits] }, the hits
+  in the header, tags and text count as the hits in the post. `comments` are
+  the texts of the comments.
+  """
+  terms = {}
+
+  def add_terms(text, where):
+    for term in get_terms(text):
+      hits = terms.get(term)
+      if hits is None:
+        hits = terms[term] = [0, 0]
+      hits[where] += 1
+
+  add_terms(header, 0)
+  for tag in tags:
+    add_terms(tag, 0)
+  add_terms(text, 0)
+  for comment in comments:
+    add_terms(comment, 1)
+  return terms
+
+
+def get_term_shard(term, shards):
+  """
+  Returns the shard of a term. The hash is computed over the UTF-16 code
+  units of the term, the same way as the search page does it.
+  """
+  h = 0
+  units = term.encode('utf-16-le')
+  for i in range(0, len(units), 2):
+    h = (h * 31 + (units[i] | units[i + 1] << 8)) & 0xFFFFFFFF
+  return h % shards
+
+
+def to_js(func, data):
+  """
+  Returns a script calling `func` with the data, such scripts can be
+  loaded by a page opened from the disk (unlike json files).
+  """
+  text = json.dumps(data, ensure_ascii=False, sort_keys=True,
+                    separators=(',', ':'))
+  return '%s(%s);\n' % (
+      func, text.replace('\u2028', '\\u2028').replace('\u2029', '\\u2029'))
+
+
+class SearchIndexBuilder():
+  """
+  Inverted index of the posts of a journal: for every term of the headers,
+  tags and texts of the posts and of the comments it keeps the posts with
+  the number of hits in the post and in its comments. The index is written
+  to 'html/search' as small scripts, one per shard of the terms, so the
+  search page loads only the shards of the terms it looks for.
+  """
+
+  def __init__(self):
+    self.terms = {}   # { term: { postid: [post hits, comment hits] } }
+    self.posts = {}   # { postid: [date, header] }
+
+  def add_post(self, postid, date, header, post_terms):
+    """
+    Adds a post with its terms, see count_post_terms.
+    """
+    self.posts[postid] = [date, header]
+    for term, hits in post_terms.items():
+      self.terms.setdefault(term, {})[postid] = hits
+
+  def get_shard_count(self):
+    shards = 1
+    while shards < SHARDS_MAX and shards * SHARD_TERMS < len(self.terms):
+      shards *= 2
+    return shards
+
+  def get_files(self):
+    """
+    Returns the files of the index { file name: contents }.
+    """
+    shards = self.get_shard_count()
+    shard_terms = [{} for _ in range(shards)]
+    for term, postings in self.terms.items():
+      shard_terms[get_term_shard(term, shards)][term] = postings
+
+    files = {
+        'posts.js': to_js('lj_search_posts', {
+            'shards': shards, 'posts': self.posts}),
+    }
+    for shard, terms in enumerate(shard_terms):
+      files['shard-%d.js' % shard] = to_js(
+          'lj_search_shard', {'shard': shard, 'terms': terms})
+    return files
+
+
+SEARCH_PAGE = """<!DOCTYPE HTML>
+<html><head>
+<meta charset="utf-8">
+<title>%(title)s: Search</title>
+<style type="text/css">
+  .search-result-date {
+    font:  10pt sans-serif;
+    color: #8B8989
+  }
+</style>
+</head>
+<body>
+
+<div class="nav">
+  <a href="./index.html">%(title)s</a> | <a href="./archive.html">Archive</a> | Search
+</div>
+
+<form id="search-form">
+  <input id="search-query" type="text" size="50" autofocus>
+  <input type="submit" value="Search">
+</form>
+<div id="search-status"></div>
+<div id="search-results"></div>
+
+<script>
+var searchShards = null;
+var searchPosts = null;
+var loadedShards = {};
+var waitingShards = {};
+
+function lj_search_posts(data) {
+  searchShards = data.shards;
+  searchPosts = data.posts;
+}
+
+function lj_search_shard(data) {
+  loadedShards[data.shard] = data.terms;
+  var callbacks = waitingShards[data.shard] || [];
+  delete waitingShards[data.shard];
+  callbacks.forEach(function(callback) { callback(); });
+}
+
+function getTerms(text) {
+  var terms = text.toLowerCase().match(/[\\p{L}\\p{N}_]+/gu) || [];
+  return terms.filter(function(term) {
+    return term.length >= %(term_min)d && term.length <= %(term_max)d;
+  });
+}
+
+function getTermShard(term) {
+  var h = 0;
+  for (var i = 0; i < term.length; i++) {
+    h = (Math.imul(h, 31) + term.charCodeAt(i)) >>> 0;
+  }
+  return h %% searchShards;
+}
+
+function loadShard(shard, callback) {
+  if (shard in loadedShards) {
+    callback();
+    return;
+  }
+  if (!(shard in waitingShards)) {
+    waitingShards[shard] = [];
+    var script = document.createElement("script");
+    script.src = "./search/shard-" + shard + ".js";
+    document.head.appendChild(script);
+  }
+  waitingShards[shard].push(callback);
+}
+
+function search(query) {
+  var terms = getTerms(query);
+  var status = document.getElementById("search-status");
+  var results = document.getElementById("search-results");
+  results.innerHTML = "";
+  if (!terms.length) {
+    status.textContent = "";
+    return;
+  }
+
+  var left = terms.length;
+  status.textContent = "Searching...";
+  terms.forEach(function(term) {
+    loadShard(getTermShard(term), function() {
+      if (--left == 0) {
+        showResults(terms);
+      }
+    });
+  });
+}
+
+function showResults(terms) {
+  // posts which have all the terms, the hits in the post weigh more
+  var scores = null;
+  terms.forEach(function(term) {
+    var postings = loadedShards[getTermShard(term)][term] || {};
+    var next = {};
+    for (var postid in postings) {
+      if (scores === null || postid in scores) {
+        var hits = postings[postid];
+        var score = scores === null ? [0, 0] : scores[postid];
+        next[postid] = [score[0] + hits[0], score[1] + hits[1]];
+      }
+    }
+    scores = next;
+  });
+
+  var postids = Object.keys(scores).sort(function(a, b) {
+    return (3 * scores[b][0] + scores[b][1]) - (3 * scores[a][0] + scores[a][1]);
+  });
+  document.getElementById("search-status").textContent =
+      postids.length + " post(s) found";
+
+  var results = document.getElementById("search-results");
+  postids.forEach(function(postid) {
+    var post = searchPosts[postid] || ["", postid];
+    var div = document.createElement("div");
+    var date = document.createElement("span");
+    date.className = "search-result-date";
+    date.textContent = post[0] + " ";
+    var link = document.createElement("a");
+    link.href = "./" + postid + ".html";
+    link.innerHTML = post[1];
+    div.appendChild(date);
+    div.appendChild(link);
+    div.appendChild(document.createTextNode(
+        " (" + scores[postid][0] + " in the post, " + scores[postid][1] +
+        " in the comments)"));
+    results.appendChild(div);
+  });
+}
+
+document.getElementById("search-form").onsubmit = function() {
+  search(document.getElementById("search-query").value);
+  return false;
+};
+</script>
+<script src="./search/posts.js"></script>
+</body>
+</html>
+"""
+
+
+def render_search_page(title):
+  return SEARCH_PAGE % {
+      'title': html.escape(title), 'term_min': TERM_MIN_LENGTH,
+      'term_max': TERM_MAX_LENGTH,
+  }
@@ -0,0 +1,254 @@
+"""
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+from download_helpers import FileDownloader
+from helpers import JsonLog, get_file_hash
+
+
+PART_SUFFIX = '.part'
+
+
+class UserpicStore():
+  """
+  Userpics shared by all the archived journals. A userpic on
+  l-userpic.livejournal.com/<uid>/<picid> never changes, so it is stored
+  once under the '<uid>/<picid>' key and every journal gets a hard link
+  to it. The keys present in the store and in the journals are kept in
+  memory, so checking a userpic does not touch the disk.
+  """
+
+  STORE_DIR_DEFAULT = './.userpics'
+
+  def __init__(self, store_dir=STORE_DIR_DEFAULT):
+    self.store_dir = store_dir
+    self.userpics = self._scan(store_dir)
+    self.journal_userpics = {}  # { journal_dir: set(keys) }
+    self.dirs = set()
+    self.downloads = {}         # { key: future }
+    logging.info("Userpic store '%s' (%d userpics)",
+                 store_dir, len(self.userpics))
+
+  @staticmethod
+  def _scan(root):
+    keys = set()
+    if not os.path.isdir(root):
+      return keys
+
+    for entry in os.scandir(root):
+      if entry.is_dir():
+        for pic in os.scandir(entry.path):
+          if pic.is_file() and not pic.name.endswith(PART_SUFFIX):
+            keys.add('%s/%s' % (entry.name, pic.name))
+      elif entry.is_file() and not entry.name.endswith(PART_SUFFIX):
+        keys.add(entry.name)
+    return keys
+
+  def _makedirs(self, path):
+    if path not in self.dirs:
+      os.makedirs(path, exist_ok=True)
+      self.dirs.add(path)
+
+  def _get_journal_userpics(self, journal_dir):
+    keys = self.journal_userpics.get(journal_dir)
+    if keys is None:
+      keys = self.journal_userpics[journal_dir] = self._scan(journal_dir)
+    return keys
+
+  def has(self, key):
+    return key in self.userpics
+
+  def is_linked(self, journal_dir, key):
+    return key in self._get_journal_userpics(journal_dir)
+
+  def link(self, journal_dir, key):
+    src = '%s/%s' % (self.store_dir, key)
+    dest = '%s/%s' % (journal_dir, key)
+    self._makedirs(os.path.dirname(dest))
+    try:
+      os.link(src, dest)
+    except FileExistsError:
+      pass
+    except OSError:
+      # hard links are not supported (e.g. another file system)
+      shutil.copyfile(src, dest)
+    self._get_journal_userpics(journal_dir).add(key)
+
+  async def download(self, url, key, semaphore, client):
+    """
+    Downloads a userpic into the store unless the same userpic is being
+    downloaded already, and returns the status code.
+    """
+    future = self.downloads.get(key)
+    if future is None:
+      future = asyncio.ensure_future(
+          self._download(url, key, semaphore, client))
+      self.downloads[key] = future
+    # a post which is abandoned does not cancel the download for the others
+    return await asyncio.shield(future)
+
+  async def _download(self, url, key, semaphore, client):
+    dest = '%s/%s' % (self.store_dir, key)
+    part = dest + PART_SUFFIX
+    self._makedirs(os.path.dirname(dest))
+    try:
+      code, _, _ = await FileDownloader.download_file(
+          url, part, semaphore, client)
+      if code == 200:
+        os.replace(part, dest)
+        self.userpics.add(key)
+      elif os.path.exists(part):
+        os.remove(part)
+      return code
+    finally:
+      del self.downloads[key]
+
+
+class ImageStore():
+  """
+  Images of one journal shared by all its posts and comments. Every file is
+  named by the hash of its contents and the manifest maps image URLs to the
+  files, so an image is downloaded once per journal and stored once even if
+  it is available under several URLs.
+  """
+
+  IMAGE_DIR = 'images'
+  MANIFEST = 'manifest.json'
+
+  def __init__(self, main_dir):
+    self.main_dir = main_dir
+    self.image_dir = '%s/%s' % (main_dir, self.IMAGE_DIR)
+    self.manifest_file = '%s/%s' % (self.image_dir, self.MANIFEST)
+    os.makedirs(self.image_dir, exist_ok=True)
+
+    self.urls = {}    # { url: filename }
+    if os.path.isfile(self.manifest_file):
+      with open(self.manifest_file, 'r', encoding='utf-8') as f:
+        self.urls = json.load(f)
+
+    self.hashes = {}  # { hash: filename }
+    for name in os.listdir(self.image_dir):
+      if name == self.MANIFEST or name.endswith(PART_SUFFIX):
+        continue
+      self.hashes[name.split('.')[0]] = '%s/%s' % (self.IMAGE_DIR, name)
+
+    self.downloads = {}  # { url: future }
+    self.changed = False
+    logging.info("Image store '%s' (%d urls, %d images)",
+                 self.image_dir, len(self.urls), len(self.hashes))
+
+  def get_filename(self, url):
+    return self.urls.get(url)
+
+  def add_files(self, files):
+    """
+    Adds already downloaded files, e.g. the ones recorded in a checkpoint.
+    """
+    for url, filename in files.items():
+      if (url not in self.urls and
+          os.path.isfile('%s/%s' % (self.main_dir, filename))):
+        self.urls[url] = filename
+        self.changed = True
+
+  async def download(self, url, fileext, semaphore, client):
+    """
+    Downloads an image into the store unless the same URL is being
+    downloaded already, and returns the status code and the filename
+    relative to the journal directory.
+    """
+    future = self.downloads.get(url)
+    if future is None:
+      future = asyncio.ensure_future(
+          self._download(url, fileext, semaphore, client))
+      self.downloads[url] = future
+    # a post which is abandoned does not cancel the download for the others
+    return await asyncio.shield(future)
+
+  async def _download(self, url, fileext, semaphore, client):
+    part = '%s/%s%s' % (
+        self.image_dir, hashlib.sha256(url.encode('utf-8')).hexdigest(),
+        PART_SUFFIX)
+    try:
+      code, _, _ = await FileDownloader.download_file(
+          url, part, semaphore, client)
+      if code != 200:
+        if os.path.exists(part):
+          os.remove(part)
+        return code, None
+
+      file_hash = get_file_hash(part)
+      filename = self.hashes.get(file_hash)
+      if filename is None:
+        filename = '%s/%s%s' % (self.IMAGE_DIR, file_hash, fileext)
+        os.replace(part, '%s/%s' % (self.main_dir, filename))
+        self.hashes[file_hash] = filename
+      else:
+        logging.info("Image '%s' is already stored as '%s'", url, filename)
+        os.remove(part)
+
+      self.urls[url] = filename
+      self.changed = True
+      return code, filename
+    finally:
+      del self.downloads[url]
+
+  def save(self):
+    if not self.changed:
+      return
+
+    tmp_file = self.manifest_file + PART_SUFFIX
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+      json.dump(self.urls, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_file, self.manifest_file)
+    self.changed = False
+
+
+class PostCheckpoint():
+  """
+  Journal of the work done for a post which is being downloaded: the comment
+  threads which have been fetched (with their json comments) and the images
+  which have been downloaded. Records are appended as soon as the work is
+  done, so if the download is interrupted the next run reads them back and
+  continues from where it stopped.
+  """
+
+  SUFFIX = '.checkpoint'
+
+  def __init__(self, main_dir, postid):
+    self.log = JsonLog('%s/%s%s' % (main_dir, postid, self.SUFFIX))
+    self.threads = {}  # { url: json comments }
+    self.files = {}    # { url: filename }
+    if self.log.exists():
+      self._load()
+
+  def _load(self):
+    for record in self.log.read():
+      if 'thread' in record:
+        self.threads[record['thread']] = record['comments']
+      elif 'file' in record:
+        self.files[record['file']] = record['filename']
+    logging.info("Resuming from checkpoint '%s' (%d threads, %d files)",
+                 self.log.filename, len(self.threads), len(self.files))
+
+  def get_thread(self, url):
+    return self.threads.get(url)
+
+  def add_thread(self, url, json_comments):
+    self.threads[url] = json_comments
+    self.log.append({'thread': url, 'comments': json_comments})
+
+  def add_file(self, url, filename):
+    self.files[url] = filename
+    self.log.append({'file': url, 'filename': filename})
+
+  def close(self):
+    self.log.close()
+
+  def remove(self):
+    self.log.remove()